@@ -0,0 +1,139 @@
+"""Runs the API for benchmarking, with storage replaced by the in-process fake.
+
+Also counts DB queries per route and exposes them, together with the process
+RSS, at ``GET /__bench__/stats``. Started by ``benchmarks.load``.
+"""
+import argparse
+import asyncio
+import contextvars
+import os
+import resource
+from collections import Counter
+
+import uvicorn
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from fastapi import HTTPException, Request
+
+from benchmarks.fake_storage import FakeStorageBackend, FakeStorageConfig, FakeStorageError, FakeSupabaseClient
+
+os.environ.setdefault("SUPABASE_URL", "http://fake-storage.local")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "fake-service-role-key")
+os.environ.setdefault("OPENAI_API_KEY_OPENAI", "fake-openai-key")
+
+_current_request: contextvars.ContextVar[dict | None] = contextvars.ContextVar("bench_current_request", default=None)
+
+queries_total = 0
+queries_by_route: Counter[str] = Counter()
+requests_by_route: Counter[str] = Counter()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    global queries_total
+    queries_total += 1
+    current = _current_request.get()
+    if current is not None:
+        current["queries"] += 1
+
+
+class QueryCountMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/__bench__"):
+            await self.app(scope, receive, send)
+            return
+
+        current = {"queries": 0}
+        token = _current_request.set(current)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_request.reset(token)
+            route = scope.get("route")
+            key = f"{scope['method']} {route.path if route else scope['path']}"
+            requests_by_route[key] += 1
+            queries_by_route[key] += current["queries"]
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return max_rss_bytes()
+
+
+def max_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create_app(storage_backend: FakeStorageBackend):
+    import main
+    import services.HomeworkService
+    from utils.utils import get_supabase_client
+
+    fake_client = FakeSupabaseClient(storage_backend)
+
+    async def get_fake_supabase_client():
+        return fake_client
+
+    main.app.dependency_overrides[get_supabase_client] = get_fake_supabase_client
+    services.HomeworkService.get_supabase_client = get_fake_supabase_client
+
+    @main.app.put("/__storage__/object/upload/sign/{bucket_id}/{path:path}", include_in_schema=False)
+    async def upload_to_signed_url(bucket_id: str, path: str, token: str, request: Request):
+        try:
+            return await fake_client.storage.from_(bucket_id).upload_to_signed_url(path, token, await request.body())
+        except FakeStorageError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @main.app.get("/__bench__/stats", include_in_schema=False)
+    async def bench_stats():
+        return {
+            "queries_total": queries_total,
+            "queries_by_route": dict(queries_by_route),
+            "requests_by_route": dict(requests_by_route),
+            "rss_bytes": rss_bytes(),
+            "max_rss_bytes": max_rss_bytes(),
+            "storage": storage_backend.stats(),
+        }
+
+    main.app.add_middleware(QueryCountMiddleware)
+    return main.app
+
+
+async def prepare_database():
+    from utils.db import sessionmanager
+    await sessionmanager.create_tables()
+    # uvicorn runs its own event loop, connections opened here must not leak into it
+    await sessionmanager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with benchmark stand-ins")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--storage-latency", type=float, default=FakeStorageConfig.latency)
+    parser.add_argument("--storage-bytes-per-second", type=float, default=FakeStorageConfig.bytes_per_second)
+    parser.add_argument("--graceful-timeout", type=int, default=None)
+    args = parser.parse_args()
+
+    storage_backend = FakeStorageBackend(
+        config=FakeStorageConfig(
+            latency=args.storage_latency,
+            bytes_per_second=args.storage_bytes_per_second,
+            public_url=f"http://{args.host}:{args.port}/__storage__",
+        )
+    )
+    app = create_app(storage_backend)
+    asyncio.run(prepare_database())
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", timeout_graceful_shutdown=args.graceful_timeout)
+
+
+if __name__ == "__main__":
+    main()
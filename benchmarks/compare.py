@@ -0,0 +1,43 @@
+"""Compares two ``benchmarks.load`` result files.
+
+    python -m benchmarks.compare benchmarks/results/load-<old>.json benchmarks/results/load-<new>.json
+"""
+import argparse
+import json
+from pathlib import Path
+
+
+def load(path: Path) -> dict:
+    report = json.loads(path.read_text())
+    return {(result["scenario"], result["concurrency"]): result for result in report["results"]}
+
+
+def change(old: float | None, new: float | None) -> str:
+    if old is None or new is None:
+        return "n/a"
+    if not old:
+        return f"{new:.1f}"
+    return f"{old:.1f} -> {new:.1f} ({(new - old) / old * 100:+.1f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two load benchmark result files")
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("candidate", type=Path)
+    args = parser.parse_args()
+
+    baseline = load(args.baseline)
+    candidate = load(args.candidate)
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        print(f"{key[0]} c={key[1]}")
+        print(f"  throughput ops/s   {change(old['throughput_ops_per_s'], new['throughput_ops_per_s'])}")
+        print(f"  db queries/request {change(old['db_queries_per_http_request'], new['db_queries_per_http_request'])}")
+        print(f"  rss MiB            {change(old['rss_bytes'] / 2**20, new['rss_bytes'] / 2**20)}")
+        for name in sorted(old["latency_ms"].keys() & new["latency_ms"].keys()):
+            for p in ("p50", "p95", "p99"):
+                print(f"  {name} {p} ms".ljust(21) + change(old["latency_ms"][name][p], new["latency_ms"][name][p]))
+
+
+if __name__ == "__main__":
+    main()
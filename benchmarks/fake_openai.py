@@ -0,0 +1,188 @@
+"""Local stand-in for the OpenAI chat completions API.
+
+Streams chat completion chunks with a configurable time to first token and
+token rate. Requests that carry an image get an XML ``<tasks>`` payload like
+the one ``ExtractTasksStepLogic`` expects, everything else gets plain text.
+
+    python -m benchmarks.fake_openai --port 8100 --ttft 0.5 --tokens-per-second 80 --tasks 5
+
+Point the app at it with ``OPENAI_BASE_URL=http://127.0.0.1:8100/v1``.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeOpenAIConfig:
+    ttft: float = 0.5
+    tokens_per_second: float = 80.0
+    tasks: int = 5
+    chat_tokens: int = 120
+    chars_per_token: int = 4
+    # Models that cut their extraction payload off halfway, to exercise escalation to a stronger plan
+    truncating_models: tuple[str, ...] = ()
+    # Share of requests answered with a 500, and of streams that stop sending tokens without closing
+    error_rate: float = 0.0
+    stall_rate: float = 0.0
+    stall_mid_stream: bool = False
+
+
+def build_tasks_payload(task_count: int) -> str:
+    tasks = []
+    for i in range(1, task_count + 1):
+        tasks.append(
+            "  <task>\n"
+            f"    <exercise-identifier>Exercise {i}</exercise-identifier>\n"
+            f"    <exercise-description>A school bus brings {30 + i} children to school every day. "
+            f"How many children does it bring in {i + 2} days?</exercise-description>\n"
+            "    <exercise-concepts>\n"
+            "      <concept>multiplication</concept>\n"
+            "      <concept>word problems</concept>\n"
+            "    </exercise-concepts>\n"
+            "  </task>\n"
+        )
+    return "<tasks>\n" + "".join(tasks) + "</tasks>"
+
+
+def build_chat_payload(token_count: int) -> str:
+    words = "Let us look at the exercise step by step and multiply the numbers together".split()
+    return " ".join(words[i % len(words)] for i in range(token_count))
+
+
+def has_image(messages: list[dict]) -> bool:
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+def split_tokens(payload: str, chars_per_token: int) -> list[str]:
+    return [payload[i:i + chars_per_token] for i in range(0, len(payload), chars_per_token)]
+
+
+def create_app(config: FakeOpenAIConfig) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "gpt-4o")
+        messages = body.get("messages", [])
+        if has_image(messages):
+            payload = build_tasks_payload(config.tasks)
+            if model in config.truncating_models:
+                payload = payload[:len(payload) // 2]
+        else:
+            payload = build_chat_payload(config.chat_tokens)
+        tokens = split_tokens(payload, config.chars_per_token)
+        prompt_tokens = len(json.dumps(messages)) // config.chars_per_token
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        if random.random() < config.error_rate:
+            return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}}, status_code=500)
+        stall_at = None
+        if random.random() < config.stall_rate:
+            stall_at = len(tokens) // 2 if config.stall_mid_stream else 0
+
+        if not body.get("stream"):
+            await asyncio.sleep(config.ttft + len(tokens) / config.tokens_per_second)
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": payload},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta: dict, finish_reason: str | None = None) -> str:
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + "\n\n"
+
+        async def stream():
+            await asyncio.sleep(config.ttft)
+            yield chunk({"role": "assistant", "content": ""})
+            interval = 1 / config.tokens_per_second
+            for i, token in enumerate(tokens):
+                if i == stall_at:
+                    # Keep the connection open without sending anything, like a hung upstream
+                    await asyncio.sleep(3600)
+                yield chunk({"content": token})
+                await asyncio.sleep(interval)
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield "data: " + json.dumps({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": usage,
+                }) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake OpenAI streaming server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ttft", type=float, default=FakeOpenAIConfig.ttft, help="Seconds until the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=FakeOpenAIConfig.tokens_per_second)
+    parser.add_argument("--tasks", type=int, default=FakeOpenAIConfig.tasks, help="Tasks per extraction payload")
+    parser.add_argument("--chat-tokens", type=int, default=FakeOpenAIConfig.chat_tokens)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Share of streams that hang before the first token")
+    parser.add_argument("--stall-mid-stream", action="store_true", help="Stalled streams hang halfway instead")
+    parser.add_argument("--truncating-model", action="append", default=[], help="Model whose extraction output is cut off, may be repeated")
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        tasks=args.tasks,
+        chat_tokens=args.chat_tokens,
+        truncating_models=tuple(args.truncating_model),
+        error_rate=args.error_rate,
+        stall_rate=args.stall_rate,
+        stall_mid_stream=args.stall_mid_stream,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
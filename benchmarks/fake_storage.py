@@ -0,0 +1,100 @@
+"""In-process stand-in for the Supabase storage client.
+
+Mimics the parts of ``supabase.AsyncClient.storage`` the app uses and keeps
+objects in memory. Latency and bandwidth can be simulated per call.
+"""
+import asyncio
+import uuid
+from dataclasses import dataclass, field
+
+
+class FakeStorageError(Exception):
+    pass
+
+
+@dataclass
+class FakeStorageConfig:
+    latency: float = 0.02
+    bytes_per_second: float = 50_000_000
+    # Where signed upload URLs point, benchmarks.app_server serves uploads to them
+    public_url: str = "http://fake-storage.local"
+
+
+@dataclass
+class FakeStorageBackend:
+    config: FakeStorageConfig = field(default_factory=FakeStorageConfig)
+    objects: dict[tuple[str, str], bytes] = field(default_factory=dict)
+    upload_tokens: dict[str, tuple[str, str]] = field(default_factory=dict)
+    uploads: int = 0
+    downloads: int = 0
+    bytes_uploaded: int = 0
+    bytes_downloaded: int = 0
+
+    async def transfer(self, size: int) -> None:
+        await asyncio.sleep(self.config.latency + size / self.config.bytes_per_second)
+
+    def stats(self) -> dict:
+        return {
+            "objects": len(self.objects),
+            "uploads": self.uploads,
+            "downloads": self.downloads,
+            "bytes_uploaded": self.bytes_uploaded,
+            "bytes_downloaded": self.bytes_downloaded,
+        }
+
+
+class FakeBucket:
+    def __init__(self, backend: FakeStorageBackend, bucket_id: str):
+        self.backend = backend
+        self.id = bucket_id
+
+    async def upload(self, path: str, file: bytes, file_options: dict | None = None) -> dict:
+        await self.backend.transfer(len(file))
+        self.backend.objects[(self.id, path)] = bytes(file)
+        self.backend.uploads += 1
+        self.backend.bytes_uploaded += len(file)
+        return {"path": path, "full_path": f"{self.id}/{path}"}
+
+    async def download(self, path: str, options: dict | None = None) -> bytes:
+        data = self.backend.objects.get((self.id, path))
+        if data is None:
+            raise FakeStorageError(f"Object not found: {self.id}/{path}")
+        await self.backend.transfer(len(data))
+        self.backend.downloads += 1
+        self.backend.bytes_downloaded += len(data)
+        return data
+
+    async def remove(self, paths: list[str]) -> list[dict]:
+        await self.backend.transfer(0)
+        removed = [path for path in paths if self.backend.objects.pop((self.id, path), None) is not None]
+        return [{"name": path} for path in removed]
+
+    async def exists(self, path: str) -> bool:
+        await self.backend.transfer(0)
+        return (self.id, path) in self.backend.objects
+
+    async def create_signed_upload_url(self, path: str, options: dict | None = None) -> dict:
+        await self.backend.transfer(0)
+        token = uuid.uuid4().hex
+        self.backend.upload_tokens[token] = (self.id, path)
+        signed_url = f"{self.backend.config.public_url}/object/upload/sign/{self.id}/{path}?token={token}"
+        return {"signed_url": signed_url, "signedUrl": signed_url, "token": token, "path": path}
+
+    async def upload_to_signed_url(self, path: str, token: str, file: bytes, file_options: dict | None = None) -> dict:
+        if self.backend.upload_tokens.pop(token, None) != (self.id, path):
+            raise FakeStorageError(f"Invalid upload token for {self.id}/{path}")
+        return await self.upload(path, file, file_options)
+
+
+class FakeStorage:
+    def __init__(self, backend: FakeStorageBackend):
+        self.backend = backend
+
+    def from_(self, bucket_id: str) -> FakeBucket:
+        return FakeBucket(self.backend, bucket_id)
+
+
+class FakeSupabaseClient:
+    def __init__(self, backend: FakeStorageBackend | None = None):
+        self.backend = backend or FakeStorageBackend()
+        self.storage = FakeStorage(self.backend)
@@ -2,10 +2,12 @@ from enum import StrEnum
 
 
 class HomeworkAssistanceRunState(StrEnum):
+    AWAITING_UPLOAD = "AWAITING_UPLOAD"
     PENDING = "PENDING"
     STARTED = "STARTED"
     SUCCEEDED = "SUCCEEDED"
     FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
 
 
 class HomeworkAssistanceRunStepState(StrEnum):
@@ -13,6 +15,7 @@ class HomeworkAssistanceRunStepState(StrEnum):
     STARTED = "STARTED"
     SUCCEEDED = "SUCCEEDED"
     FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
 
 
 class HomeworkAssistanceRunStepName(StrEnum):
@@ -25,3 +28,9 @@ class MediaUploadState(StrEnum):
     PENDING = "PENDING"
     SUCCESS = "SUCCESS"
     FAILED = "FAILED"
+
+
+class LlmUsageSource(StrEnum):
+    EXTRACT_TASKS = "EXTRACT_TASKS"
+    EXPLANATION = "EXPLANATION"
+    CHAT = "CHAT"
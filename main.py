@@ -1,35 +1,120 @@
 import asyncio
+import contextlib
 import os
+import secrets
+import time
 import uuid
+from collections import Counter
 from datetime import datetime
 
-import supabase
-import uvicorn
-from fastapi import FastAPI, APIRouter, UploadFile, HTTPException
+from fastapi import FastAPI, APIRouter, UploadFile, HTTPException, Header
 from fastapi.openapi.utils import get_openapi
 from fastapi.params import Depends, File
 from fastapi.routing import APIRoute
+from opentelemetry import trace
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.background import BackgroundTasks
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import StreamingResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
-from enums import HomeworkAssistanceRunState, MediaUploadState
-from models import Media
+from enums import HomeworkAssistanceRunState, HomeworkAssistanceRunStepState, MediaUploadState
+from models import HomeworkAssistanceRun, Media
 from request_models import CreateServerRequest, CreateServerResponse, CreateUserRequest, CreateUserResponse, \
     UserWithIdModel, CreateHomeworkAssistantRunRequest, CreateHomeworkAssistantRunResponse, HomeworkAssistanceRunStatus, \
-    Message, GetHomeworkAssistanceRunStatusResponse, GetHomeworkAssistanceRunTasksResponse, TaskResponse
-from services.HomeworkService import HomeworkService, StepLogicFactory
+    Message, GetHomeworkAssistanceRunStatusResponse, GetHomeworkAssistanceRunTasksResponse, TaskResponse, \
+    UsageSummaryResponse, CreateHomeworkUploadRequest, CreateHomeworkUploadResponse, StorageWebhookRequest, \
+    CreateHomeworkBatchResponse, GetHomeworkBatchStatusResponse, HomeworkBatchRunStatus, HomeworkAssistanceRunSnapshotResponse, \
+    CancelHomeworkAssistanceRunResponse
+from services.HomeworkService import AbstractStepLogic, HomeworkService, StepLogicFactory
+from services.SnapshotService import SnapshotService
+from services.UsageService import UsageService
 from services.UserService import UserService
-from utils.db import sessionmanager, get_db
-from utils.dependencies import get_user_service, get_homework_service
+from utils import images, lifecycle
+from utils.db import DATABASE_POOL_SIZE, sessionmanager, get_db
+from utils.dependencies import get_user_service, get_homework_service, get_usage_service, get_snapshot_service
+from utils.llm import get_openai_client
+from utils.metrics import ADMISSION_REJECTIONS, MetricsMiddleware, STEPS_QUEUED, WARMUP_DURATION, mark_process_dead, \
+    metrics_endpoint, observe_pool
+from utils.archives import BULK_MAX_BYTES, BULK_MAX_FILES, ArchiveError, is_zip, unpack_zip
+from utils.rate_limit import rate_limiter
+from utils.scheduler import run_scheduler
+from utils.storage import HOMEWORK_BUCKET, create_signed_upload, homework_storage_path, object_exists, upload_object
+from utils.tracing import TracingMiddleware, configure_tracing
 from utils.utils import get_supabase_client
 
+configure_tracing()
+
 user_router = APIRouter(prefix="/user")
 
 homework_assistant_router = APIRouter(prefix="/homework-assistant")
 
+storage_router = APIRouter(prefix="/storage")
+
+STORAGE_WEBHOOK_SECRET = os.environ.get("STORAGE_WEBHOOK_SECRET")
+BULK_UPLOAD_CONCURRENCY = int(os.environ.get("BULK_UPLOAD_CONCURRENCY", "8"))
+# Safety net for hand-back notifications a worker missed, e.g. while it was starting up
+RESUME_INTERVAL_SECONDS = float(os.environ.get("RESUME_INTERVAL_SECONDS", "30"))
+
+def reject_when_draining() -> None:
+    if lifecycle.is_draining():
+        raise HTTPException(
+            status_code=503,
+            detail="Server is shutting down",
+            headers={"Retry-After": str(lifecycle.DRAIN_RETRY_AFTER_SECONDS)},
+        )
+
+
+def admit_runs(user_id: str, runs: int = 1) -> None:
+    rejection = run_scheduler.check_admission(user_id, runs)
+    if rejection is not None:
+        limit, retry_after = rejection
+        ADMISSION_REJECTIONS.labels(limit=limit).inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many homework runs queued, try again later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+async def run_steps(user_id: str, homework_assistance_run_id: str, logics: list[AbstractStepLogic]) -> None:
+    remaining = list(logics)
+    try:
+        await run_scheduler.acquire(user_id)
+    except asyncio.CancelledError:
+        for logic in remaining:
+            STEPS_QUEUED.labels(step=logic.step_name().value).dec()
+        if not lifecycle.is_run_cancelled(homework_assistance_run_id):
+            # Shut down before the run got a slot, give it back so the next worker resumes it
+            async with sessionmanager.session() as session:
+                await get_homework_service().hand_back_run(session=session, homework_assistance_run_id=homework_assistance_run_id)
+        raise
+
+    started = time.perf_counter()
+    try:
+        while remaining:
+            await remaining.pop(0).run(homework_assistance_run_id)
+    finally:
+        # Steps that never started because the run was cancelled or the worker shut down
+        for logic in remaining:
+            STEPS_QUEUED.labels(step=logic.step_name().value).dec()
+        run_scheduler.release(user_id, run_seconds=time.perf_counter() - started)
+
+
+def schedule_steps(homework_assistance_run: HomeworkAssistanceRun) -> None:
+    trace.get_current_span().set_attribute("homework.run_id", homework_assistance_run.id)
+    logics = [
+        StepLogicFactory.resolve(step) for step in homework_assistance_run.steps
+        if step.state != HomeworkAssistanceRunStepState.SUCCEEDED
+    ]
+    for logic in logics:
+        STEPS_QUEUED.labels(step=logic.step_name().value).inc()
+    # Runs wait for a slot of the fair scheduler, so one user's backlog cannot hold back everyone else
+    lifecycle.spawn(
+        run_steps(homework_assistance_run.user_id, homework_assistance_run.id, logics),
+        run_id=homework_assistance_run.id,
+    )
+
+
 @user_router.post("", tags=["user"])
 async def create_user(create_user_request: CreateUserRequest, user_service: UserService = Depends(get_user_service), session: AsyncSession = Depends(get_db)) -> CreateUserResponse:
     user = await user_service.create_user(request=create_user_request, session=session)
@@ -53,12 +138,13 @@ async def get_user(user_id: str, user_service: UserService = Depends(get_user_se
     )
 
 
-@homework_assistant_router.post("", tags=["homework"])
-async def trigger_homework_assistance_run(create_homework_assistant_run_request: CreateHomeworkAssistantRunRequest, background_tasks: BackgroundTasks, homework_service: HomeworkService = Depends(get_homework_service), session: AsyncSession = Depends(get_db)) -> CreateHomeworkAssistantRunResponse:
+@homework_assistant_router.post("", tags=["homework"], dependencies=[Depends(reject_when_draining)])
+async def trigger_homework_assistance_run(create_homework_assistant_run_request: CreateHomeworkAssistantRunRequest, homework_service: HomeworkService = Depends(get_homework_service), session: AsyncSession = Depends(get_db)) -> CreateHomeworkAssistantRunResponse:
+    admit_runs(create_homework_assistant_run_request.user_id)
     homework_assistance_run = await homework_service.create_homework_assistance_run(request=create_homework_assistant_run_request, session=session)
-    for step in homework_assistance_run.steps:
-        logic = StepLogicFactory.resolve(step)
-        background_tasks.add_task(logic.run, homework_assistance_run.id)
+    await session.commit()
+    await session.refresh(homework_assistance_run)
+    schedule_steps(homework_assistance_run)
     return CreateHomeworkAssistantRunResponse(
         homework_run_id=homework_assistance_run.id,
     )
@@ -75,64 +161,295 @@ async def get_homework_assistance_run_state(homework_assistance_run_id: str, hom
     )
 
 
-@homework_assistant_router.post("/chat/{homework_assistance_run_id}", tags=["homework"])
+@homework_assistant_router.post("/chat/{homework_assistance_run_id}", tags=["homework"], dependencies=[Depends(reject_when_draining)])
 async def chat(homework_assistance_run_id: str, messages: list[Message], homework_service: HomeworkService = Depends(get_homework_service), session: AsyncSession = Depends(get_db)):
-    return StreamingResponse(homework_service.on_chat_message(session=session, homework_assistance_run_id=homework_assistance_run_id, messages=messages), media_type="text/plain")
+    try:
+        chat_stream = await homework_service.on_chat_message(session=session, homework_assistance_run_id=homework_assistance_run_id, messages=messages)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Homework assistance run not found")
+    return StreamingResponse(chat_stream, media_type="text/plain")
 
 
-@user_router.post("/{user_id}/upload-homework/", tags=["user"])
+@user_router.post("/{user_id}/upload-homework/", tags=["user"], dependencies=[Depends(reject_when_draining)], deprecated=True)
 async def upload_homework(
     user_id: str,
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     homework_service: HomeworkService = Depends(get_homework_service),
     session: AsyncSession = Depends(get_db),
-    supabase_client: supabase.AsyncClient = Depends(get_supabase_client)
+    supabase_client=Depends(get_supabase_client),
+    snapshot_service: SnapshotService = Depends(get_snapshot_service),
 ) -> CreateHomeworkAssistantRunResponse:
-    SUPABASE_BUCKET = "homework-files"
+    admit_runs(user_id)
     contents = await file.read()
 
-    filename = f"{uuid.uuid4()}_{file.filename}"
-    storage_path = f"{user_id}/homeworks/{filename}"
+    storage_path = homework_storage_path(user_id, file.filename)
     media = Media(
         id=str(uuid.uuid4()),
         path=storage_path,
         state=MediaUploadState.PENDING,
     )
-    session.add(media)
     homework_assistance_run = await homework_service.create_homework_assistance_run(
         request=CreateHomeworkAssistantRunRequest(
             file_id=media.id,
             user_id=user_id,
         ),
-        session=session
+        session=session,
+        medias=[media],
     )
-    media.run_id = homework_assistance_run.id
     await session.commit()
     await session.refresh(homework_assistance_run)
 
-    for step in homework_assistance_run.steps:
-        logic = StepLogicFactory.resolve(step)
-        background_tasks.add_task(logic.run, homework_assistance_run.id)
-
     try:
-        await supabase_client.storage.from_(SUPABASE_BUCKET).upload(storage_path, contents)
+        await upload_object(supabase_client, storage_path, contents)
     except Exception as e:
         media.state = MediaUploadState.FAILED
+        # The steps never start without the file, the run would otherwise stay STARTED forever
+        homework_assistance_run.state = HomeworkAssistanceRunState.FAILED
+        await snapshot_service.update(
+            session=session, run_ids=[homework_assistance_run.id], state=HomeworkAssistanceRunState.FAILED
+        )
         raise HTTPException(status_code=500, detail=f"Upload failed: {e}")
     else:
         media.state = MediaUploadState.SUCCESS
     finally:
         session.add(media)
+        await snapshot_service.set_media_state(session=session, run_ids=[homework_assistance_run.id], state=media.state)
         await session.commit()
         await session.refresh(media)
         await session.refresh(homework_assistance_run)
 
+    # Started only now, the steps read the file from storage
+    schedule_steps(homework_assistance_run)
+
     return CreateHomeworkAssistantRunResponse(
         homework_assistance_run_id=homework_assistance_run.id,
     )
 
 
+@user_router.post("/{user_id}/homework-uploads", tags=["user"], dependencies=[Depends(reject_when_draining)])
+async def create_homework_upload(
+    user_id: str,
+    create_homework_upload_request: CreateHomeworkUploadRequest,
+    homework_service: HomeworkService = Depends(get_homework_service),
+    session: AsyncSession = Depends(get_db),
+    supabase_client=Depends(get_supabase_client),
+) -> CreateHomeworkUploadResponse:
+    storage_path = homework_storage_path(user_id, create_homework_upload_request.filename)
+    signed_upload = await create_signed_upload(supabase_client, storage_path)
+
+    media = Media(
+        id=str(uuid.uuid4()),
+        path=storage_path,
+        state=MediaUploadState.PENDING,
+    )
+    homework_assistance_run = await homework_service.create_homework_assistance_run(
+        request=CreateHomeworkAssistantRunRequest(
+            file_id=media.id,
+            user_id=user_id,
+        ),
+        session=session,
+        state=HomeworkAssistanceRunState.AWAITING_UPLOAD,
+        medias=[media],
+    )
+    response = CreateHomeworkUploadResponse(
+        homework_assistance_run_id=homework_assistance_run.id,
+        media_id=media.id,
+        path=storage_path,
+        upload_url=signed_upload["signed_url"],
+        upload_token=signed_upload["token"],
+    )
+    await session.commit()
+    return response
+
+
+@user_router.post("/{user_id}/homework-batches", tags=["user"], dependencies=[Depends(reject_when_draining)])
+async def create_homework_batch(
+    user_id: str,
+    files: list[UploadFile] = File(...),
+    homework_service: HomeworkService = Depends(get_homework_service),
+    session: AsyncSession = Depends(get_db),
+    supabase_client=Depends(get_supabase_client),
+) -> CreateHomeworkBatchResponse:
+    uploads = []
+    total_bytes = 0
+    for file in files:
+        filename = file.filename or ""
+        # Nothing past the cap is read into memory, archives included
+        contents = await file.read(BULK_MAX_BYTES - total_bytes + 1)
+        if total_bytes + len(contents) > BULK_MAX_BYTES:
+            raise HTTPException(status_code=400, detail=f"Batch is larger than {BULK_MAX_BYTES} bytes")
+        if is_zip(filename, contents):
+            try:
+                unpacked = unpack_zip(contents)
+            except ArchiveError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            unpacked = [(filename, contents)]
+        total_bytes += sum(len(data) for _, data in unpacked)
+        if total_bytes > BULK_MAX_BYTES:
+            raise HTTPException(status_code=400, detail=f"Batch is larger than {BULK_MAX_BYTES} bytes")
+        uploads.extend(unpacked)
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No files to process")
+    if len(uploads) > BULK_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_FILES} files per batch")
+    admit_runs(user_id, runs=len(uploads))
+
+    storage_paths = [homework_storage_path(user_id, filename) for filename, _ in uploads]
+    homework_batch = await homework_service.create_homework_batch(session=session, user_id=user_id, storage_paths=storage_paths)
+    batch_id = homework_batch.id
+    run_ids = list(homework_batch.run_ids)
+    await session.commit()
+    trace.get_current_span().set_attributes({"homework.batch_id": batch_id, "homework.batch_size": len(run_ids)})
+
+    semaphore = asyncio.Semaphore(BULK_UPLOAD_CONCURRENCY)
+
+    async def upload(storage_path: str, contents: bytes) -> bool:
+        async with semaphore:
+            try:
+                await upload_object(supabase_client, storage_path, contents)
+            except Exception as e:
+                print(f"Upload of {storage_path} failed: {e}")
+                return False
+            return True
+
+    uploaded = await asyncio.gather(*(
+        upload(storage_path, contents) for storage_path, (_, contents) in zip(storage_paths, uploads)
+    ))
+    homework_assistance_runs = await homework_service.complete_batch_uploads(
+        session=session,
+        uploaded_run_ids=[run_id for run_id, ok in zip(run_ids, uploaded) if ok],
+        failed_run_ids=[run_id for run_id, ok in zip(run_ids, uploaded) if not ok],
+    )
+    for homework_assistance_run in homework_assistance_runs:
+        schedule_steps(homework_assistance_run)
+
+    return CreateHomeworkBatchResponse(
+        batch_id=batch_id,
+        homework_assistance_run_ids=run_ids,
+        failed_files=[filename for (filename, _), ok in zip(uploads, uploaded) if not ok],
+    )
+
+
+@homework_assistant_router.get("/batch/{batch_id}", tags=["homework"])
+async def get_homework_batch_status(
+        batch_id: str,
+        homework_service: HomeworkService = Depends(get_homework_service),
+        session: AsyncSession = Depends(get_db),
+) -> GetHomeworkBatchStatusResponse:
+    homework_batch = await homework_service.get_batch(session=session, batch_id=batch_id)
+    if homework_batch is None:
+        raise HTTPException(status_code=404, detail="Homework batch not found")
+    run_states = await homework_service.get_batch_run_states(session=session, homework_batch=homework_batch)
+    runs = [
+        HomeworkBatchRunStatus(homework_assistance_run_id=run_id, state=run_states[run_id])
+        for run_id in homework_batch.run_ids if run_id in run_states
+    ]
+    return GetHomeworkBatchStatusResponse(
+        batch_id=homework_batch.id,
+        total=len(runs),
+        finished=sum(run.state in (HomeworkAssistanceRunState.SUCCEEDED, HomeworkAssistanceRunState.FAILED, HomeworkAssistanceRunState.CANCELLED) for run in runs),
+        states=dict(Counter(run.state.value for run in runs)),
+        runs=runs,
+    )
+
+
+@homework_assistant_router.post("/{homework_assistance_run_id}/upload-complete", tags=["homework"], dependencies=[Depends(reject_when_draining)])
+async def complete_homework_upload(
+    homework_assistance_run_id: str,
+    homework_service: HomeworkService = Depends(get_homework_service),
+    session: AsyncSession = Depends(get_db),
+    supabase_client=Depends(get_supabase_client),
+) -> CreateHomeworkAssistantRunResponse:
+    try:
+        homework_assistance_run = await homework_service.get_run(session=session, homework_assistance_run_id=homework_assistance_run_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Homework assistance run not found")
+
+    if homework_assistance_run.state == HomeworkAssistanceRunState.AWAITING_UPLOAD:
+        for media in homework_assistance_run.medias:
+            if not await object_exists(supabase_client, media.path):
+                raise HTTPException(status_code=409, detail="Upload has not finished yet")
+        # A rejected run stays waiting for its upload, the client completes it again after Retry-After
+        admit_runs(homework_assistance_run.user_id)
+        if await homework_service.complete_upload(session=session, homework_assistance_run=homework_assistance_run):
+            schedule_steps(homework_assistance_run)
+
+    return CreateHomeworkAssistantRunResponse(
+        homework_assistance_run_id=homework_assistance_run_id,
+    )
+
+
+@homework_assistant_router.post("/{homework_assistance_run_id}/cancel", tags=["homework"])
+async def cancel_homework_assistance_run(
+    homework_assistance_run_id: str,
+    homework_service: HomeworkService = Depends(get_homework_service),
+    session: AsyncSession = Depends(get_db),
+) -> CancelHomeworkAssistanceRunResponse:
+    state = await homework_service.cancel_run(session=session, homework_assistance_run_id=homework_assistance_run_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Homework assistance run not found")
+    if state != HomeworkAssistanceRunState.CANCELLED:
+        raise HTTPException(status_code=409, detail=f"Homework assistance run already {state.value.lower()}")
+    # Other workers abort on the notification, a run on this worker does not have to wait for it
+    lifecycle.cancel_run(homework_assistance_run_id)
+    return CancelHomeworkAssistanceRunResponse(homework_assistance_run_id=homework_assistance_run_id, state=state)
+
+
+@storage_router.post("/webhook", include_in_schema=False)
+async def storage_webhook(
+    storage_webhook_request: StorageWebhookRequest,
+    x_webhook_secret: str | None = Header(default=None),
+    homework_service: HomeworkService = Depends(get_homework_service),
+    session: AsyncSession = Depends(get_db),
+):
+    # Supabase database webhook on INSERT into storage.objects, the object exists once it fires
+    if not STORAGE_WEBHOOK_SECRET or not secrets.compare_digest(x_webhook_secret or "", STORAGE_WEBHOOK_SECRET):
+        raise HTTPException(status_code=401, detail="Invalid webhook secret")
+    record = storage_webhook_request.record or {}
+    if storage_webhook_request.type != "INSERT" or record.get("bucket_id") != HOMEWORK_BUCKET:
+        return {"status": "ignored"}
+
+    homework_assistance_run = await homework_service.get_run_by_media_path(session=session, path=record.get("name", ""))
+    if (
+        homework_assistance_run is None
+        or lifecycle.is_draining()
+        or run_scheduler.check_admission(homework_assistance_run.user_id) is not None
+    ):
+        # Runs left waiting are started by the client's upload-complete call
+        return {"status": "ignored"}
+    if await homework_service.complete_upload(session=session, homework_assistance_run=homework_assistance_run):
+        schedule_steps(homework_assistance_run)
+    return {"status": "ok"}
+
+
+@homework_assistant_router.get("/run/{homework_assistance_run_id}/snapshot", tags=["homework"])
+async def get_homework_assistance_run_snapshot(
+        homework_assistance_run_id: str,
+        if_none_match: str | None = Header(default=None),
+        homework_service: HomeworkService = Depends(get_homework_service),
+        snapshot_service: SnapshotService = Depends(get_snapshot_service),
+        session: AsyncSession = Depends(get_db),
+) -> HomeworkAssistanceRunSnapshotResponse:
+    snapshot = await snapshot_service.get(session=session, run_id=homework_assistance_run_id)
+    if snapshot is not None:
+        document, version = snapshot.document, snapshot.version
+    else:
+        # Runs created before snapshots existed get theirs on first read
+        try:
+            homework_assistance_run = await homework_service.get_run(session=session, homework_assistance_run_id=homework_assistance_run_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail="Homework assistance run not found")
+        document, version = await snapshot_service.save(session=session, run=homework_assistance_run), 1
+        await session.commit()
+
+    etag = f'"{version}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    # The stored document is served as is, it was shaped like the response when it was written
+    return JSONResponse({**document, "version": version}, headers={"ETag": etag})
+
+
 @homework_assistant_router.get("/status/{homework_assistance_run_id}", tags=["homework"])
 async def get_homework_assistance_run_status(
         homework_assistance_run_id: str,
@@ -161,6 +478,25 @@ async def get_homework_assistance_run_tasks(
     )
 
 
+@user_router.get("/{user_id}/usage", tags=["user"])
+async def get_user_usage(
+        user_id: str,
+        since: datetime | None = None,
+        usage_service: UsageService = Depends(get_usage_service),
+        session: AsyncSession = Depends(get_db),
+) -> UsageSummaryResponse:
+    return await usage_service.get_usage_summary(session=session, user_id=user_id, since=since)
+
+
+@homework_assistant_router.get("/run/{homework_assistance_run_id}/usage", tags=["homework"])
+async def get_homework_assistance_run_usage(
+        homework_assistance_run_id: str,
+        usage_service: UsageService = Depends(get_usage_service),
+        session: AsyncSession = Depends(get_db),
+) -> UsageSummaryResponse:
+    return await usage_service.get_usage_summary(session=session, run_id=homework_assistance_run_id)
+
+
 def custom_generate_unique_id(route: APIRoute):
     return f"{route.tags[0]}-{route.name}"
 
@@ -170,6 +506,81 @@ def use_route_names_as_operation_ids(route: APIRoute):
 
 
 
+async def warmup() -> None:
+    started = time.perf_counter()
+    await asyncio.gather(
+        sessionmanager.warmup(connections=DATABASE_POOL_SIZE),
+        get_supabase_client(),
+        asyncio.to_thread(get_openai_client),
+        asyncio.to_thread(images.preload),
+    )
+    observe_pool(sessionmanager.engine)
+    WARMUP_DURATION.set(time.perf_counter() - started)
+
+
+async def resume_handed_back_runs(run_ids: list[str] | None = None) -> None:
+    homework_service = get_homework_service()
+    async with sessionmanager.session() as session:
+        homework_assistance_runs = await homework_service.claim_handed_back_runs(session=session, run_ids=run_ids)
+    for homework_assistance_run in homework_assistance_runs:
+        schedule_steps(homework_assistance_run)
+
+
+def on_run_handed_back(homework_assistance_run_id: str) -> None:
+    # A worker shutting down during a rolling deploy, one of the workers still running takes the run over
+    if not lifecycle.is_draining():
+        lifecycle.spawn(resume_handed_back_runs(run_ids=[homework_assistance_run_id]))
+
+
+async def catch_up_on_notifications() -> None:
+    # Runs may have been cancelled or handed back while the LISTEN connection was down
+    run_ids = lifecycle.running_run_ids()
+    if run_ids:
+        async with sessionmanager.session() as session:
+            cancelled_run_ids = await get_homework_service().get_cancelled_run_ids(session=session, run_ids=run_ids)
+        for run_id in cancelled_run_ids:
+            lifecycle.cancel_run(run_id)
+    if not lifecycle.is_draining():
+        await resume_handed_back_runs()
+
+
+async def resume_handed_back_runs_periodically() -> None:
+    while not lifecycle.is_draining():
+        await asyncio.sleep(RESUME_INTERVAL_SECONDS)
+        if lifecycle.is_draining():
+            break
+        try:
+            await resume_handed_back_runs()
+        except Exception as e:
+            print(f"Resuming handed back runs failed: {e}")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # uvicorn only starts accepting connections once this returns, so the worker is warm when it reports ready
+    await warmup()
+    lifecycle.install_drain_signal_handlers()
+    async with sessionmanager.listen({
+        lifecycle.RUN_CANCELLED_CHANNEL: lifecycle.cancel_run,
+        lifecycle.RUN_HANDED_BACK_CHANNEL: on_run_handed_back,
+    }, on_reconnect=catch_up_on_notifications):
+        await resume_handed_back_runs()
+        resuming = asyncio.create_task(resume_handed_back_runs_periodically())
+        yield
+        resuming.cancel()
+        # uvicorn has already waited for open requests, steps still running get cancelled and hand their run back
+        await lifecycle.drain()
+    await rate_limiter.close()
+    await sessionmanager.close()
+    mark_process_dead()
+
+
+async def health():
+    if lifecycle.is_draining():
+        return JSONResponse({"status": "draining"}, status_code=503)
+    return {"status": "ok"}
+
+
 app = FastAPI(openapi_tags=[
     {
         "name": "User",
@@ -181,23 +592,29 @@ app = FastAPI(openapi_tags=[
     }
 ],
     generate_unique_id_function=use_route_names_as_operation_ids,  # we’ll override it ourselves
-
+    lifespan=lifespan,
 )
 
 
 app.include_router(user_router)
+app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+app.add_api_route("/health", health, methods=["GET"], include_in_schema=False)
 
 app.include_router(homework_assistant_router)
+app.include_router(storage_router)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 
 if __name__ == "__main__":
+    # Development server, production deployments run `python manage.py migrate` and `python manage.py serve`
     import subprocess
     asyncio.run(sessionmanager.create_tables())
     subprocess.run(["uvicorn", "main:app", "--host", "0.0.0.0", "--port", "8000", "--reload"])
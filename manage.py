@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import datetime
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+
+def serve(args: argparse.Namespace) -> None:
+    import uvicorn
+
+    if args.workers > 1 and not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Every worker writes its metrics here so /metrics reports the whole server, not one worker
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="impehrium-metrics-")
+    elif os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Files left by a previous server would be summed into this one's metrics
+        metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            if name.endswith(".db"):
+                os.remove(os.path.join(metrics_dir, name))
+
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=args.loop,
+        http=args.http,
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        limit_concurrency=args.limit_concurrency,
+        proxy_headers=True,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+        access_log=args.access_log,
+        log_level=args.log_level,
+    )
+
+
+def migrate(args: argparse.Namespace) -> None:
+    from utils.db import sessionmanager
+
+    async def run() -> None:
+        await sessionmanager.create_tables()
+        await sessionmanager.close()
+
+    asyncio.run(run())
+
+
+def reparse_tasks(args: argparse.Namespace) -> None:
+    from services.HomeworkService import HomeworkService
+    from utils.db import sessionmanager
+    from utils.utils import get_supabase_client
+
+    async def run() -> None:
+        homework_service = HomeworkService()
+        supabase_client = await get_supabase_client()
+        async with sessionmanager.session() as session:
+            run_ids = args.run_id or await homework_service.get_runs_with_extraction_artifacts(session=session, since=args.since)
+        for run_id in run_ids:
+            # One transaction per run, a run that fails to parse does not roll back the others
+            async with sessionmanager.session() as session:
+                tasks = await homework_service.reparse_tasks(session=session, supabase_client=supabase_client, homework_assistance_run_id=run_id)
+                if tasks is None:
+                    print(f"{run_id}: no extraction output stored")
+                    continue
+                if args.dry_run:
+                    await session.rollback()
+                else:
+                    await session.commit()
+                print(f"{run_id}: {len(tasks)} tasks")
+        await sessionmanager.close()
+
+    asyncio.run(run())
+
+
+def compact_artifacts(args: argparse.Namespace) -> None:
+    from services.ArtifactService import ArtifactService
+    from utils.db import sessionmanager
+    from utils.utils import get_supabase_client
+
+    async def run() -> None:
+        artifact_service = ArtifactService()
+        supabase_client = await get_supabase_client()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with sessionmanager.session() as session:
+            expired = await artifact_service.expire_artifacts(
+                session=session, supabase_client=supabase_client, older_than=now - datetime.timedelta(days=args.retention_days)
+            )
+            compacted = await artifact_service.compact_artifacts(
+                session=session, supabase_client=supabase_client, older_than=now - datetime.timedelta(days=args.hot_days)
+            )
+        await sessionmanager.close()
+        print(f"Expired {expired} artifacts, compacted {compacted} into archive bundles")
+
+    asyncio.run(run())
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Impehrium management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the production server")
+    serve_parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    serve_parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    serve_parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    serve_parser.add_argument("--loop", default="uvloop", choices=["auto", "asyncio", "uvloop"])
+    serve_parser.add_argument("--http", default="httptools", choices=["auto", "h11", "httptools"])
+    serve_parser.add_argument("--backlog", type=int, default=2048)
+    # Longer than the idle timeout of the load balancer in front, otherwise it reuses connections we already closed
+    serve_parser.add_argument("--keep-alive", type=int, default=75, help="Seconds an idle keep-alive connection stays open")
+    # Steps drain from the signal on too, so shutdown takes at most this plus the hand-back timeout
+    serve_parser.add_argument("--graceful-timeout", type=int, default=int(os.environ.get("STEP_DRAIN_TIMEOUT", "20")), help="Seconds open requests and steps get to finish on shutdown")
+    serve_parser.add_argument("--limit-concurrency", type=int, default=None)
+    serve_parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    serve_parser.add_argument("--access-log", action=argparse.BooleanOptionalAction, default=False)
+    serve_parser.add_argument("--log-level", default="info")
+    serve_parser.set_defaults(handler=serve)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Create missing database tables")
+    migrate_parser.set_defaults(handler=migrate)
+
+    reparse_parser = subparsers.add_parser("reparse-tasks", help="Rebuild tasks from stored extraction output")
+    reparse_parser.add_argument("--run-id", action="append", help="Run to reparse, may be repeated, defaults to all runs")
+    reparse_parser.add_argument("--since", type=datetime.datetime.fromisoformat, default=None, help="Only runs extracted after this ISO timestamp")
+    reparse_parser.add_argument("--dry-run", action="store_true")
+    reparse_parser.set_defaults(handler=reparse_tasks)
+
+    compact_parser = subparsers.add_parser("compact-artifacts", help="Archive old LLM artifacts and expire the oldest")
+    compact_parser.add_argument("--hot-days", type=int, default=int(os.environ.get("ARTIFACT_HOT_DAYS", "30")), help="Artifacts older than this move to archive bundles")
+    compact_parser.add_argument("--retention-days", type=int, default=int(os.environ.get("ARTIFACT_RETENTION_DAYS", "365")), help="Artifacts older than this are deleted")
+    compact_parser.set_defaults(handler=compact_artifacts)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import uuid
 from collections.abc import Callable
 
 from pydantic import UUID5, UUID4
-from sqlalchemy import ForeignKey, CheckConstraint
+from sqlalchemy import ForeignKey, CheckConstraint, DateTime, LargeBinary
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -125,5 +125,76 @@ class HomeworkAssistanceRun(Base):
         return None
 
 
+class LlmUsage(Base):
+    __tablename__ = "llm_usages"
 
+    id: Mapped[str] = mapped_column(primary_key=True, default=uuid4_str)
+    run_id: Mapped[str] = mapped_column(ForeignKey("homework_assistance_runs.id", ondelete="CASCADE"), index=True)
+    user_id: Mapped[str] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    source: Mapped[str]
+    model: Mapped[str]
+    prompt_tokens: Mapped[int]
+    completion_tokens: Mapped[int]
+    cost_usd: Mapped[float]
+    estimated: Mapped[bool] = mapped_column(default=False)
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+        index=True,
+    )
+
+
+class HomeworkBatch(Base):
+    __tablename__ = "homework_batches"
+
+    id: Mapped[str] = mapped_column(primary_key=True, default=uuid4_str)
+    user_id: Mapped[str] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    run_ids: Mapped[list[str]] = mapped_column(JSONB)
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+    )
+
+
+class HomeworkAssistanceRunSnapshot(Base):
+    __tablename__ = "homework_assistance_run_snapshots"
+
+    run_id: Mapped[str] = mapped_column(ForeignKey("homework_assistance_runs.id", ondelete="CASCADE"), primary_key=True)
+    run: Mapped["HomeworkAssistanceRun"] = relationship()
+    document: Mapped[dict] = mapped_column(JSONB)
+    version: Mapped[int] = mapped_column(default=1)
+    updated_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+    )
+
+
+class LlmArtifact(Base):
+    __tablename__ = "llm_artifacts"
+
+    id: Mapped[str] = mapped_column(primary_key=True, default=uuid4_str)
+    run_id: Mapped[str] = mapped_column(ForeignKey("homework_assistance_runs.id", ondelete="CASCADE"), index=True)
+    user_id: Mapped[str] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    source: Mapped[str]
+    model: Mapped[str]
+    details: Mapped[dict | None] = mapped_column(JSONB)
+    codec: Mapped[str]
+    raw_size: Mapped[int]
+    # Cleared once the artifact is compacted into an archive bundle in storage
+    content: Mapped[bytes | None] = mapped_column(LargeBinary)
+    archive_path: Mapped[str | None]
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+        index=True,
+    )
+
+
+class LlmRateBucket(Base):
+    __tablename__ = "llm_rate_buckets"
 
+    model: Mapped[str] = mapped_column(primary_key=True)
+    # Requests and tokens left in the per minute buckets as of updated_at, refilled lazily on every take
+    requests: Mapped[float]
+    tokens: Mapped[float]
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
@@ -57,6 +57,43 @@ class CreateHomeworkAssistantRunResponse(BaseModel):
     homework_assistance_run_id: str
 
 
+class CreateHomeworkUploadRequest(BaseModel):
+    filename: str
+
+
+class CreateHomeworkUploadResponse(BaseModel):
+    homework_assistance_run_id: str
+    media_id: str
+    path: str
+    upload_url: str
+    upload_token: str
+
+
+class CreateHomeworkBatchResponse(BaseModel):
+    batch_id: str
+    homework_assistance_run_ids: list[str]
+    failed_files: list[str]
+
+
+class HomeworkBatchRunStatus(BaseModel):
+    homework_assistance_run_id: str
+    state: HomeworkAssistanceRunState
+
+
+class GetHomeworkBatchStatusResponse(BaseModel):
+    batch_id: str
+    total: int
+    finished: int
+    states: dict[str, int]
+    runs: list[HomeworkBatchRunStatus]
+
+
+class StorageWebhookRequest(BaseModel):
+    type: str
+    table: str
+    record: dict | None = None
+
+
 class GetHomeworkAssistanceRunStatusResponse(BaseModel):
     homework_assistance_run_id: str
     step_states: list[dict]
@@ -72,3 +109,45 @@ class TaskResponse(BaseModel):
 class GetHomeworkAssistanceRunTasksResponse(BaseModel):
     homework_assistance_run_id: str
     tasks: list[TaskResponse]
+
+
+class UsageBreakdown(BaseModel):
+    model: str
+    source: str
+    calls: int
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+
+
+class UsageSummaryResponse(BaseModel):
+    user_id: str | None
+    homework_assistance_run_id: str | None
+    since: datetime.datetime | None
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+    breakdown: list[UsageBreakdown]
+
+
+class MediaSnapshot(BaseModel):
+    id: str
+    path: str
+    state: str
+
+
+class HomeworkAssistanceRunSnapshotResponse(BaseModel):
+    homework_assistance_run_id: str
+    user_id: str
+    state: HomeworkAssistanceRunState
+    labels: list[str]
+    explanation: str | None
+    steps: dict[str, HomeworkAssistanceRunStepState]
+    tasks: list[TaskResponse]
+    medias: list[MediaSnapshot]
+    version: int
+
+
+class CancelHomeworkAssistanceRunResponse(BaseModel):
+    homework_assistance_run_id: str
+    state: HomeworkAssistanceRunState
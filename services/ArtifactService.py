@@ -0,0 +1,135 @@
+import datetime
+import json
+import os
+import uuid
+from collections import defaultdict
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import LlmArtifact
+from utils.storage import download_object, remove_objects, upload_object
+
+ARTIFACT_BUCKET = "llm-artifacts"
+ARTIFACT_HOT_DAYS = int(os.environ.get("ARTIFACT_HOT_DAYS", "30"))
+ARTIFACT_RETENTION_DAYS = int(os.environ.get("ARTIFACT_RETENTION_DAYS", "365"))
+ARTIFACT_COMPRESSION_LEVEL = int(os.environ.get("ARTIFACT_COMPRESSION_LEVEL", "9"))
+ARTIFACT_CODEC = "zstd"
+
+
+def compress(data: bytes) -> bytes:
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=ARTIFACT_COMPRESSION_LEVEL).compress(data)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec != ARTIFACT_CODEC:
+        raise ValueError(f"Unknown artifact codec: {codec}")
+    import zstandard
+
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def start_of_day(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class ArtifactService:
+    async def record_artifact(self, session: AsyncSession, run_id: str, user_id: str, source: str, model: str, output: str, details: dict | None = None) -> LlmArtifact:
+        raw = output.encode("utf-8")
+        llm_artifact = LlmArtifact(
+            run_id=run_id,
+            user_id=user_id,
+            source=source,
+            model=model,
+            details=details,
+            codec=ARTIFACT_CODEC,
+            raw_size=len(raw),
+            content=compress(raw),
+        )
+        session.add(llm_artifact)
+        return llm_artifact
+
+    async def get_latest_artifact(self, session: AsyncSession, run_id: str, source: str) -> LlmArtifact | None:
+        result = await session.execute(
+            select(LlmArtifact)
+            .where(LlmArtifact.run_id == run_id, LlmArtifact.source == source)
+            .order_by(LlmArtifact.created_at.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
+
+    async def read_artifact(self, supabase_client, llm_artifact: LlmArtifact) -> str:
+        if llm_artifact.content is not None:
+            return decompress(llm_artifact.content, llm_artifact.codec).decode("utf-8")
+
+        bundle = await download_object(supabase_client, llm_artifact.archive_path, bucket=ARTIFACT_BUCKET)
+        for line in decompress(bundle, ARTIFACT_CODEC).splitlines():
+            record = json.loads(line)
+            if record["id"] == llm_artifact.id:
+                return record["output"]
+        raise LookupError(f"Artifact {llm_artifact.id} is missing from {llm_artifact.archive_path}")
+
+    async def compact_artifacts(self, session: AsyncSession, supabase_client, older_than: datetime.datetime, batch_size: int = 500) -> int:
+        # Old artifacts move out of the table into one bundle per day, compressing them together also
+        # compresses far better than the single outputs do on their own
+        compacted = 0
+        while True:
+            result = await session.execute(
+                select(LlmArtifact)
+                .where(LlmArtifact.content.is_not(None), LlmArtifact.created_at < older_than)
+                .order_by(LlmArtifact.created_at)
+                .limit(batch_size)
+            )
+            llm_artifacts = list(result.scalars().all())
+            if not llm_artifacts:
+                return compacted
+
+            by_day = defaultdict(list)
+            for llm_artifact in llm_artifacts:
+                by_day[llm_artifact.created_at.date()].append(llm_artifact)
+
+            for day, day_artifacts in by_day.items():
+                lines = [
+                    json.dumps({
+                        "id": llm_artifact.id,
+                        "run_id": llm_artifact.run_id,
+                        "user_id": llm_artifact.user_id,
+                        "source": llm_artifact.source,
+                        "model": llm_artifact.model,
+                        "details": llm_artifact.details,
+                        "created_at": llm_artifact.created_at.isoformat(),
+                        "output": decompress(llm_artifact.content, llm_artifact.codec).decode("utf-8"),
+                    })
+                    for llm_artifact in day_artifacts
+                ]
+                archive_path = f"{day.isoformat()}/{uuid.uuid4()}.jsonl.zst"
+                # Uploaded before the rows point to it, an interrupted run leaves an unused bundle, never a lost artifact
+                # Nothing reads a bundle soon after writing it, keep it out of the blob cache of worksheets
+                await upload_object(supabase_client, archive_path, compress("\n".join(lines).encode("utf-8")), bucket=ARTIFACT_BUCKET, cache=False)
+                await session.execute(
+                    update(LlmArtifact)
+                    .where(LlmArtifact.id.in_([llm_artifact.id for llm_artifact in day_artifacts]))
+                    .values(content=None, archive_path=archive_path)
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+                compacted += len(day_artifacts)
+            session.expunge_all()
+
+    async def expire_artifacts(self, session: AsyncSession, supabase_client, older_than: datetime.datetime) -> int:
+        # Bundles hold one day each, cutting at a day boundary removes whole bundles only
+        older_than = start_of_day(older_than)
+        result = await session.execute(
+            delete(LlmArtifact)
+            .where(LlmArtifact.created_at < older_than)
+            .returning(LlmArtifact.archive_path)
+        )
+        archive_paths = list(result.scalars().all())
+        await session.commit()
+
+        bundles = sorted({archive_path for archive_path in archive_paths if archive_path})
+        if bundles:
+            await remove_objects(supabase_client, bundles, bucket=ARTIFACT_BUCKET)
+        return len(archive_paths)
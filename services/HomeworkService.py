@@ -1,38 +1,54 @@
+import dataclasses
+import datetime
 import xml.etree.ElementTree
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator
 
-
-from PIL import Image
-
-import tempfile
-from pdf2image import convert_from_bytes
-import base64
-from io import BytesIO
+import asyncio
 import os
 import re
 import textwrap
+import time
+import traceback
 
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from opentelemetry import context as otel_context
+from opentelemetry.trace import Status, StatusCode
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from request_models import CreateHomeworkAssistantRunRequest, Message, GetHomeworkAssistanceRunStatusResponse
 import uuid
-from enums import HomeworkAssistanceRunState, HomeworkAssistanceRunStepState, HomeworkAssistanceRunStepName
-from utils.db import DatabaseSessionManager, DATABASE_URL
+from enums import HomeworkAssistanceRunState, HomeworkAssistanceRunStepState, HomeworkAssistanceRunStepName, LlmUsageSource, MediaUploadState
 
 
 from abc import ABC, abstractmethod
-from sqlalchemy import select
+from sqlalchemy import delete, func, select, update
 from enums import HomeworkAssistanceRunStepName
-from models import HomeworkAssistanceRun, HomeworkAssistanceRunStep, Media, Task
+from models import HomeworkAssistanceRun, HomeworkAssistanceRunStep, HomeworkBatch, LlmArtifact, Media, Task
 from utils.db import sessionmanager
+from utils.images import PageSignals, count_pages, encode_image, measure_page, rasterize_first_page
+from services.ArtifactService import ArtifactService
+from services.SnapshotService import SnapshotService, task_document
+from services.UsageService import UsageService
+from utils.lifecycle import RUN_CANCELLED_CHANNEL, RUN_HANDED_BACK_CHANNEL, is_run_cancelled, spawn, track_current_task, \
+    untrack_task
+from utils.llm import TokenUsage, estimate_cost, estimate_image_tokens, estimate_text_tokens, stream_chat_completion
+from utils.metrics import EXTRACTION_ROUTES_TAKEN, STEP_DURATION, STEPS_IN_FLIGHT, STEPS_QUEUED, track_queries
+from utils.rate_limit import PRIORITY_INTERACTIVE
+from utils.storage import read_object
+from utils.tracing import tracer
 from utils.utils import get_supabase_client
 
+if TYPE_CHECKING:
+    from PIL.Image import Image
+
 load_dotenv()
 
 class AbstractStepLogic(ABC):
     def __init__(self, step: HomeworkAssistanceRunStep):
         self.step = step
+        # Logic is resolved while the scheduling request is handled, so its span becomes the parent
+        self.trace_context = otel_context.get_current()
 
     @classmethod
     @abstractmethod
@@ -40,8 +56,46 @@ class AbstractStepLogic(ABC):
         raise NotImplementedError
 
     async def run(self, run_id: str) -> None:
-        success = await self._run(run_id=run_id)
-        await self._post_run(run_id=run_id, success=success)
+        step_name = self.step_name().value
+        STEPS_QUEUED.labels(step=step_name).dec()
+        in_flight = STEPS_IN_FLIGHT.labels(step=step_name)
+        in_flight.inc()
+        started = time.perf_counter()
+        outcome = "error"
+        task = track_current_task()
+        try:
+            with tracer.start_as_current_span(
+                f"step {step_name}",
+                context=self.trace_context,
+                attributes={"homework.run_id": run_id, "homework.step": step_name},
+            ) as span, track_queries(f"step:{step_name}"):
+                success = await self._run(run_id=run_id)
+                await self._post_run(run_id=run_id, success=success)
+                if not success:
+                    span.set_status(Status(StatusCode.ERROR, "step failed"))
+            outcome = "success" if success else "failed"
+        except asyncio.CancelledError:
+            if is_run_cancelled(run_id):
+                # Cancelled by the user, the LLM stream or download was aborted, drop what the step wrote
+                outcome = "cancelled"
+                cleanup = spawn(self._abort(run_id=run_id))
+            else:
+                # The worker is shutting down, give the step back so the next worker resumes it
+                outcome = "handed_back"
+                cleanup = spawn(self._hand_back(run_id=run_id))
+            # Runs as its own task, a second cancel of the step must not interrupt it halfway
+            await asyncio.shield(cleanup)
+            raise
+        except Exception:
+            # Provider, database or image errors alike, fail the step instead of leaving the run STARTED
+            outcome = "failed"
+            print(f"Step {step_name} of run {run_id} failed")
+            traceback.print_exc()
+            await self._post_run(run_id=run_id, success=False)
+        finally:
+            untrack_task(task)
+            in_flight.dec()
+            STEP_DURATION.labels(step=step_name, outcome=outcome).observe(time.perf_counter() - started)
 
     async def _run(self, run_id: str) -> None:
         raise NotImplementedError
@@ -54,18 +108,72 @@ class AbstractStepLogic(ABC):
             run: HomeworkAssistanceRun = result.scalar_one_or_none()
             if not run:
                 return
+            if run.state == HomeworkAssistanceRunState.CANCELLED:
+                # Cancelled while the step finished, before its task could be aborted
+                step = run.get_step(self.step.step_name)
+                if step and step.state != HomeworkAssistanceRunStepState.CANCELLED:
+                    step.state = HomeworkAssistanceRunStepState.CANCELLED
+                    await SnapshotService().set_step_state(session=session, run_id=run_id, step_name=self.step_name(), state=step.state)
+                await self._discard_partial_results(session=session, run=run)
+                await session.commit()
+                return
 
+            snapshot_service = SnapshotService()
             step = run.get_step(self.step.step_name)
             if step:
                 step.state = HomeworkAssistanceRunStepState.SUCCEEDED if success else HomeworkAssistanceRunStepState.FAILED
                 session.add(step)
+                await snapshot_service.set_step_state(session=session, run_id=run_id, step_name=self.step_name(), state=step.state)
 
             if run.finished:
                 run.state = HomeworkAssistanceRunState.SUCCEEDED
+                await snapshot_service.update(session=session, run_ids=[run_id], state=run.state)
+            elif not success:
+                # Nothing retries a failed step, the run cannot succeed anymore
+                run.state = HomeworkAssistanceRunState.FAILED
+                await snapshot_service.update(session=session, run_ids=[run_id], state=run.state)
 
             session.add(run)
+            if not success:
+                await self._discard_partial_results(session=session, run=run)
             await session.commit()
 
+    async def _hand_back(self, run_id: str) -> None:
+        async with sessionmanager.session() as session:
+            result = await session.execute(
+                select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id == run_id)
+            )
+            run = result.scalar_one_or_none()
+            if not run or run.state == HomeworkAssistanceRunState.CANCELLED:
+                return
+
+            snapshot_service = SnapshotService()
+            step = run.get_step(self.step.step_name)
+            if step and step.state != HomeworkAssistanceRunStepState.SUCCEEDED:
+                step.state = HomeworkAssistanceRunStepState.PENDING
+                await snapshot_service.set_step_state(session=session, run_id=run_id, step_name=self.step_name(), state=step.state)
+                await self._discard_partial_results(session=session, run=run)
+            if run.state == HomeworkAssistanceRunState.STARTED:
+                run.state = HomeworkAssistanceRunState.PENDING
+                await snapshot_service.update(session=session, run_ids=[run_id], state=run.state)
+                # Workers that keep running claim the run as soon as this commits
+                await session.execute(select(func.pg_notify(RUN_HANDED_BACK_CHANNEL, run_id)))
+            await session.commit()
+
+    async def _abort(self, run_id: str) -> None:
+        async with sessionmanager.session() as session:
+            result = await session.execute(
+                select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id == run_id)
+            )
+            run = result.scalar_one_or_none()
+            if not run:
+                return
+            await self._discard_partial_results(session=session, run=run)
+            await session.commit()
+
+    async def _discard_partial_results(self, session: AsyncSession, run: HomeworkAssistanceRun) -> None:
+        pass
+
 
 class LabelingStepLogic(AbstractStepLogic):
     @classmethod
@@ -73,8 +181,7 @@ class LabelingStepLogic(AbstractStepLogic):
         return HomeworkAssistanceRunStepName.LABELING
 
     async def _run(self, run_id: str) -> bool:
-        new_session_manager = DatabaseSessionManager(DATABASE_URL)
-        async with new_session_manager.session() as session:
+        async with sessionmanager.session() as session:
             result = await session.execute(
                 select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id == run_id)
             )
@@ -84,17 +191,195 @@ class LabelingStepLogic(AbstractStepLogic):
 
             run.labels = ["fractions", "multiplication", "grade 5 math"]
             session.add(run)
+            await SnapshotService().update(session=session, run_ids=[run_id], labels=run.labels)
             await session.commit()
             return True
 
+EXTRACT_TASKS_PROMPT = "Extract all homework tasks from this image and respond with XML structure:\n<tasks>\n  <task>\n    <exercise-identifier>The identifier or task name (e.g. Exercise 321)</exercise-identifier>\n    <exercise-description>The extracted text of the description of the exercise</exercise-description><exercise-concepts>\n    <concept>\n    Concept used, one phrase, use multiple concept tags for multiple concepts(e.g. fractions, integrals)\n    </concept>\n  </exercise-concepts></task>\n  ...\n</tasks>"
+EXPECTED_EXTRACTION_COMPLETION_TOKENS = 1500
+
+
+def split_tasks(buffer: str) -> tuple[list[str], str]:
+    task_xmls = []
+    while "<task>" in buffer and "</task>" in buffer:
+        start = buffer.find("<task>")
+        end = buffer.find("</task>") + len("</task>")
+        task_xmls.append(buffer[start:end])
+        buffer = buffer[end:]
+    return task_xmls, buffer
+
+
+def parse_task(task_xml: str, run_id: str) -> Task | None:
+    try:
+        task_element = xml.etree.ElementTree.fromstring(task_xml)
+    except xml.etree.ElementTree.ParseError as err:
+        print("XML Parse error", err)
+        return None
+
+    try:
+        identifier = task_element.find("exercise-identifier").text.strip()
+        description = task_element.find("exercise-description").text.strip()
+        concepts = [concept.text.strip() for concept in task_element.find("exercise-concepts").findall("concept")]
+    except AttributeError:
+        print("Task is missing elements", task_xml)
+        return None
+    return Task(
+        id=str(uuid.uuid4()),
+        description=description,
+        concepts=concepts,
+        key=identifier,
+        run_id=run_id,
+    )
+
+
+@dataclass
+class ExtractionPlan:
+    model: str
+    max_side: int | None
+    detail: str
+
+    @property
+    def label(self) -> str:
+        return f"{self.model}/{self.max_side or 'full'}/{self.detail}"
+
+    def estimate_prompt_tokens(self, image_size: tuple[int, int]) -> int:
+        width, height = image_size
+        if self.max_side is not None:
+            scale = min(1.0, self.max_side / max(width, height))
+            width, height = int(width * scale), int(height * scale)
+        return estimate_text_tokens(EXTRACT_TASKS_PROMPT) + estimate_image_tokens(self.model, width, height, self.detail)
+
+    def estimate_cost(self, image_size: tuple[int, int]) -> float:
+        return estimate_cost(self.model, self.estimate_prompt_tokens(image_size), EXPECTED_EXTRACTION_COMPLETION_TOKENS)
+
+
+# Ordered from cheapest to strongest
+EXTRACTION_PLANS = [
+    ExtractionPlan(model="gpt-4o-mini", max_side=512, detail="low"),
+    ExtractionPlan(model="gpt-4o-mini", max_side=1024, detail="high"),
+    ExtractionPlan(model="gpt-4o", max_side=1024, detail="high"),
+    ExtractionPlan(model="gpt-4o", max_side=None, detail="high"),
+]
+# Complexity from which a page starts on a plan, the lowest plan is only used when the budget is tight
+EXTRACTION_ROUTES = [(0.0, 1), (0.35, 2), (0.7, 3)]
+# Above this grayscale entropy a page is a photo rather than a scan or export
+PHOTO_ENTROPY = 4.5
+
+
+def page_complexity(signals: PageSignals) -> float:
+    return (
+        0.5 * min(1.0, signals.edge_density / 0.15)
+        + 0.3 * min(1.0, signals.ink_density / 0.10)
+        + 0.2 * min(1.0, (signals.page_count - 1) / 4)
+    )
+
+
+@dataclass
+class ExtractionRoute:
+    plan: ExtractionPlan
+    image_format: str
+    complexity: float
+
+
+def route_extraction(signals: PageSignals, remaining_budget: float, image_size: tuple[int, int]) -> ExtractionRoute | None:
+    complexity = page_complexity(signals)
+    preferred = max(index for threshold, index in EXTRACTION_ROUTES if complexity >= threshold)
+    # Photos are far smaller as JPEG, scans compress well as PNG and keep their glyph edges sharp
+    image_format = "jpeg" if signals.entropy >= PHOTO_ENTROPY else "png"
+    for plan in reversed(EXTRACTION_PLANS[:preferred + 1]):
+        if plan.estimate_cost(image_size) <= remaining_budget:
+            return ExtractionRoute(plan=plan, image_format=image_format, complexity=complexity)
+    return None
+
+
+def escalate_extraction(route: ExtractionRoute, remaining_budget: float, image_size: tuple[int, int]) -> ExtractionRoute | None:
+    # Straight to the strongest plan still affordable, a second cheap attempt rarely fixes the output
+    for plan in reversed(EXTRACTION_PLANS[EXTRACTION_PLANS.index(route.plan) + 1:]):
+        if plan.estimate_cost(image_size) <= remaining_budget:
+            return ExtractionRoute(plan=plan, image_format=route.image_format, complexity=route.complexity)
+    return None
+
+
 class ExtractTasksStepLogic(AbstractStepLogic):
     @classmethod
     def step_name(cls) -> HomeworkAssistanceRunStepName:
         return HomeworkAssistanceRunStepName.EXTRACT_TASKS
 
+    async def _discard_partial_results(self, session: AsyncSession, run: HomeworkAssistanceRun) -> None:
+        await session.execute(delete(Task).where(Task.run_id == run.id))
+        await SnapshotService().update(session=session, run_ids=[run.id], tasks=[])
+
+    async def _extract(self, session: AsyncSession, run_id: str, user_id: str, image: "Image", route: ExtractionRoute) -> tuple[str, TokenUsage, int, int]:
+        plan = route.plan
+
+        def prepare_image() -> tuple[str, tuple[int, int]]:
+            resized = image
+            if plan.max_side is not None:
+                # Resize a copy, an escalated attempt may need the full resolution again
+                resized = image.copy()
+                resized.thumbnail((plan.max_side, plan.max_side))
+            return encode_image(resized, image_format=route.image_format), resized.size
+
+        with tracer.start_as_current_span("encode_image", attributes={"image.format": route.image_format}):
+            # Off the event loop, a full resolution page takes long enough to stall every other stream
+            image_base64, image_size = await asyncio.to_thread(prepare_image)
+
+        usage = TokenUsage(prompt_tokens=plan.estimate_prompt_tokens(image_size))
+        # Reading the budget opened a transaction, do not keep its connection for the whole stream
+        await session.commit()
+        response = stream_chat_completion(
+            model=plan.model,
+            operation="extract_tasks",
+            usage=usage,
+            expected_completion_tokens=EXPECTED_EXTRACTION_COMPLETION_TOKENS,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": EXTRACT_TASKS_PROMPT},
+                        {"type": "image_url", "image_url": {"url": f"data:image/{route.image_format};base64,{image_base64}", "detail": plan.detail}},
+                    ],
+                }
+            ],
+        )
+
+        snapshot_service = SnapshotService()
+        raw_output = []
+        buffer = ""
+        task_count = 0
+        malformed_count = 0
+        try:
+            async for content in response:
+                raw_output.append(content)
+                buffer += content
+
+                task_xmls, buffer = split_tasks(buffer)
+                for task_xml in task_xmls:
+                    task = parse_task(task_xml, run_id=run_id)
+                    if task is None:
+                        malformed_count += 1
+                        continue
+                    task_count += 1
+                    session.add(task)
+                    await snapshot_service.append_task(session=session, run_id=run_id, task=task)
+                    await session.commit()
+        finally:
+            # Tokens of a stream that failed halfway were billed all the same
+            if usage.prompt_tokens or usage.completion_tokens:
+                await UsageService().record_usage(
+                    session=session,
+                    run_id=run_id,
+                    user_id=user_id,
+                    source=LlmUsageSource.EXTRACT_TASKS,
+                    model=plan.model,
+                    usage=usage,
+                )
+                await session.commit()
+
+        return "".join(raw_output), usage, task_count, malformed_count
+
     async def _run(self, run_id: str) -> bool:
-        new_session_manager = DatabaseSessionManager(DATABASE_URL)
-        async with new_session_manager.session() as session:
+        async with sessionmanager.session() as session:
             result = await session.execute(
                 select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id == run_id)
             )
@@ -102,117 +387,139 @@ class ExtractTasksStepLogic(AbstractStepLogic):
             if not run:
                 return False
 
-            step = run.get_step(self.step.step_name)
-            step.state = HomeworkAssistanceRunStepState.STARTED
-            session.add(step)
+            user_id = run.user_id
+            snapshot_service = SnapshotService()
+            step_id = run.get_step(self.step.step_name).id
+            # Conditional like the final write below, a run cancelled while it was queued does not start
+            result = await session.execute(
+                update(HomeworkAssistanceRunStep)
+                .where(
+                    HomeworkAssistanceRunStep.id == step_id,
+                    HomeworkAssistanceRunStep.state != HomeworkAssistanceRunStepState.CANCELLED,
+                )
+                .values(state=HomeworkAssistanceRunStepState.STARTED)
+            )
+            if result.rowcount != 1:
+                await session.rollback()
+                return False
+            await snapshot_service.set_step_state(
+                session=session, run_id=run_id, step_name=self.step_name(), state=HomeworkAssistanceRunStepState.STARTED
+            )
             await session.commit()
             await session.refresh(run)
 
-            media = run.medias[0]
+            media_path = run.medias[0].path
+            # Ends the transaction, the connection goes back to the pool for the download and the LLM calls
+            await session.commit()
 
             supabase_client = await get_supabase_client()
-            client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY_OPENAI"))
-
-            bucket_name = "homework-files"
-
-            downloaded_bytes = await supabase_client.storage.from_(bucket_name).download(
-                media.path
-            )
-
-            file_extension = os.path.splitext(media.path)[1].lower()
-
-            def encode_image(image):
-                buffered = BytesIO()
-                image.save(buffered, format="PNG")
-                return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-            if file_extension == '.pdf':
-                pages = convert_from_bytes(downloaded_bytes, dpi=300)
-                first_page_image = pages[0]
-            else:
-                first_page_image = Image.open(BytesIO(downloaded_bytes)).convert('RGB')
-
-            image_base64 = encode_image(first_page_image)
-
-            response = await client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Extract all homework tasks from this image and respond with XML structure:\n<tasks>\n  <task>\n    <exercise-identifier>The identifier or task name (e.g. Exercise 321)</exercise-identifier>\n    <exercise-description>The extracted text of the description of the exercise</exercise-description><exercise-concepts>\n    <concept>\n    Concept used, one phrase, use multiple concept tags for multiple concepts(e.g. fractions, integrals)\n    </concept>\n  </exercise-concepts></task>\n  ...\n</tasks>"},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
-                        ],
-                    }
-                ],
-                stream=True,
-            )
+            media_contents = await read_object(supabase_client, media_path)
 
-            buffer = ""
-            async for message in response:
-                if hasattr(message.choices[0], "delta") and hasattr(message.choices[0].delta, "content"):
-                    content = message.choices[0].delta.content or ""
-                    buffer += content
+            file_extension = os.path.splitext(media_path)[1].lower()
 
-                    while "<task>" in buffer and "</task>" in buffer:
-                        print(buffer)
-                        start = buffer.find("<task>")
-                        end = buffer.find("</task>") + len("</task>")
-
-                        task_xml = buffer[start:end]
-
-                        try:
-                            task_element = xml.etree.ElementTree.fromstring(task_xml)
-                            identifier = task_element.find("exercise-identifier").text.strip()
-                            description = task_element.find("exercise-description").text.strip()
-                            concepts = [concept.text.strip() for concept in task_element.find("exercise-concepts").findall("concept")]
-
-                            task = Task(
-                                id=str(uuid.uuid4()),
-                                description=description,
-                                concepts=concepts,
-                                key=identifier,
-                                run_id=run_id,
-                            )
+            with tracer.start_as_current_span("rasterize", attributes={"media.extension": file_extension}):
+                first_page_image, page_count = await asyncio.gather(
+                    asyncio.to_thread(rasterize_first_page, media_contents, file_extension),
+                    asyncio.to_thread(count_pages, media_contents, file_extension),
+                )
 
-                            session.add(task)
-                            await session.commit()
+            usage_service = UsageService()
+            remaining_budget = await usage_service.get_remaining_budget(session=session, user_id=user_id, run_id=run_id)
+            with tracer.start_as_current_span("route_extraction") as span:
+                signals = await asyncio.to_thread(measure_page, first_page_image, page_count=page_count)
+                route = route_extraction(signals=signals, remaining_budget=remaining_budget, image_size=first_page_image.size)
+                span.set_attributes({f"page.{name}": value for name, value in dataclasses.asdict(signals).items()})
+                if route is not None:
+                    span.set_attributes({"extraction.plan": route.plan.label, "extraction.complexity": route.complexity})
+            if route is None:
+                print(f"Budget exhausted for run {run_id}, {remaining_budget:.4f} USD left")
+                return False
 
-                        except xml.etree.ElementTree.ParseError as err:
-                            print("XML Parse error", err)
+            attempt = 1
+            while True:
+                started = time.perf_counter()
+                output, usage, task_count, malformed_count = await self._extract(
+                    session=session, run_id=run_id, user_id=user_id, image=first_page_image, route=route
+                )
+                duration = time.perf_counter() - started
+
+                escalation = None
+                usable = task_count > 0 and malformed_count == 0 and "</tasks>" in output
+                if not usable:
+                    remaining_budget = await usage_service.get_remaining_budget(session=session, user_id=user_id, run_id=run_id)
+                    escalation = escalate_extraction(route=route, remaining_budget=remaining_budget, image_size=first_page_image.size)
+                outcome = "accepted" if usable else "escalated" if escalation else "exhausted"
+                EXTRACTION_ROUTES_TAKEN.labels(plan=route.plan.label, outcome=outcome).inc()
+                print(
+                    f"Extraction route for run {run_id}: attempt {attempt} {route.plan.label} {route.image_format} "
+                    f"complexity {route.complexity:.2f}, {task_count} tasks, {malformed_count} malformed, "
+                    f"{duration:.1f}s, {outcome}"
+                )
+                await ArtifactService().record_artifact(
+                    session=session,
+                    run_id=run_id,
+                    user_id=user_id,
+                    source=LlmUsageSource.EXTRACT_TASKS,
+                    model=route.plan.model,
+                    output=output,
+                    details={
+                        "max_side": route.plan.max_side,
+                        "detail": route.plan.detail,
+                        "image_format": route.image_format,
+                        "attempt": attempt,
+                        "complexity": route.complexity,
+                        "signals": dataclasses.asdict(signals),
+                        "outcome": outcome,
+                        "duration_seconds": duration,
+                    },
+                )
+                if escalation is None:
+                    break
 
-                        buffer = buffer[end:]
+                await session.refresh(run)
+                await self._discard_partial_results(session=session, run=run)
+                await session.commit()
+                route = escalation
+                attempt += 1
 
-            run.extracted_tasks = buffer
-            step.state = HomeworkAssistanceRunStepState.SUCCEEDED
-
-            session.add(run)
-            session.add(step)
+            # Only while still STARTED, a cancellation committed in the meantime keeps the step CANCELLED
+            result = await session.execute(
+                update(HomeworkAssistanceRunStep)
+                .where(
+                    HomeworkAssistanceRunStep.id == step_id,
+                    HomeworkAssistanceRunStep.state == HomeworkAssistanceRunStepState.STARTED,
+                )
+                .values(state=HomeworkAssistanceRunStepState.SUCCEEDED)
+            )
+            if result.rowcount == 1:
+                await snapshot_service.set_step_state(
+                    session=session, run_id=run_id, step_name=self.step_name(), state=HomeworkAssistanceRunStepState.SUCCEEDED
+                )
             await session.commit()
-            await session.refresh(run)
-            await session.refresh(step)
 
             return True
 
+EXPECTED_EXPLANATION_COMPLETION_TOKENS = 800
+
+
 class ExplanationStepLogic(AbstractStepLogic):
     @classmethod
     def step_name(cls) -> HomeworkAssistanceRunStepName:
         return HomeworkAssistanceRunStepName.EXPLANATION
 
     async def _run(self, run_id: str) -> bool:
-        new_session_manager = DatabaseSessionManager(DATABASE_URL)
-        async with new_session_manager.session() as session:
+        async with sessionmanager.session() as session:
             result = await session.execute(
                 select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id == run_id)
             )
             run = result.scalar_one_or_none()
             if not run:
                 return False
+            user_id = run.user_id
             step = run.get_step(self.step.step_name)
             step.state = HomeworkAssistanceRunStepState.STARTED
             session.add(step)
             await session.commit()
-            client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY_OPENAI"))
             example_homework = """
             Aufgabe 2 – Sachaufgabe:
             Ein Schulbus bringt jeden Tag 38 Kinder zur Schule.
@@ -224,15 +531,44 @@ class ExplanationStepLogic(AbstractStepLogic):
             messages = [{"role": "user", "content": textwrap.dedent(f"""
                 USE MARKDOWN! - Generate an explanation for a parent teaching it's child the following Homework Assignment, what is to do, which concepts are important to understand?: {example_homework}
             """)}]
-            response = await client.chat.completions.create(
+            usage_service = UsageService()
+            remaining_budget = await usage_service.get_remaining_budget(session=session, user_id=user_id, run_id=run_id)
+            usage = TokenUsage(prompt_tokens=estimate_text_tokens(messages[0]["content"]))
+            if estimate_cost("gpt-4o-mini", usage.prompt_tokens, EXPECTED_EXPLANATION_COMPLETION_TOKENS) > remaining_budget:
+                print(f"Budget exhausted for run {run_id}, {remaining_budget:.4f} USD left")
+                return False
+            # Ends the budget read, the stream must not hold a pooled connection
+            await session.commit()
+
+            complete_message = ""
+            try:
+                async for content in stream_chat_completion(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    operation="explanation",
+                    usage=usage,
+                    expected_completion_tokens=EXPECTED_EXPLANATION_COMPLETION_TOKENS,
+                ):
+                    complete_message += content
+            finally:
+                if usage.prompt_tokens or usage.completion_tokens:
+                    await usage_service.record_usage(
+                        session=session,
+                        run_id=run_id,
+                        user_id=user_id,
+                        source=LlmUsageSource.EXPLANATION,
+                        model="gpt-4o-mini",
+                        usage=usage,
+                    )
+                    await session.commit()
+            await ArtifactService().record_artifact(
+                session=session,
+                run_id=run_id,
+                user_id=user_id,
+                source=LlmUsageSource.EXPLANATION,
                 model="gpt-4o-mini",
-                messages=messages,
-                stream=True
+                output=complete_message,
             )
-            complete_message = ""
-            async for message in response:
-                if hasattr(message.choices[0], "delta") and hasattr(message.choices[0].delta, "content") and message.choices[0].delta.content:
-                    complete_message += message.choices[0].delta.content if message.choices[0].delta.content else ""
 
             complete_message = re.sub(
                 r'\\\[(.*?)\\\]',       # match \[ … \]
@@ -255,6 +591,9 @@ class ExplanationStepLogic(AbstractStepLogic):
             run.explanation = complete_message
 
             step.state = HomeworkAssistanceRunStepState.SUCCEEDED
+            snapshot_service = SnapshotService()
+            await snapshot_service.update(session=session, run_ids=[run_id], explanation=run.explanation)
+            await snapshot_service.set_step_state(session=session, run_id=run_id, step_name=self.step_name(), state=step.state)
             session.add(step)
             session.add(run)
             await session.commit()
@@ -279,12 +618,22 @@ class StepLogicFactory:
         return logic_class(step)
 
 
+CHAT_MODEL = "gpt-4o-mini"
+EXPECTED_CHAT_COMPLETION_TOKENS = 500
+
+
 class HomeworkService:
-    async def create_homework_assistance_run(self, session: AsyncSession, request: CreateHomeworkAssistantRunRequest) -> HomeworkAssistanceRun:
+    async def create_homework_assistance_run(
+            self,
+            session: AsyncSession,
+            request: CreateHomeworkAssistantRunRequest,
+            state: HomeworkAssistanceRunState = HomeworkAssistanceRunState.STARTED,
+            medias: list[Media] | None = None,
+    ) -> HomeworkAssistanceRun:
         homework_assistance_run = HomeworkAssistanceRun(
             id=str(uuid.uuid4()),
             file_id=request.file_id,
-            state=HomeworkAssistanceRunState.STARTED,
+            state=state,
             user_id=request.user_id,
             steps=[
                 HomeworkAssistanceRunStep(
@@ -299,8 +648,238 @@ class HomeworkService:
             ]
         )
         session.add(homework_assistance_run)
+        for media in medias or []:
+            media.run_id = homework_assistance_run.id
+            session.add(media)
+        SnapshotService().create(session=session, run=homework_assistance_run, medias=medias or [])
         return homework_assistance_run
 
+    async def create_homework_batch(self, session: AsyncSession, user_id: str, storage_paths: list[str]) -> HomeworkBatch:
+        homework_assistance_run_ids = []
+        for storage_path in storage_paths:
+            media = Media(
+                id=str(uuid.uuid4()),
+                path=storage_path,
+                state=MediaUploadState.PENDING,
+            )
+            homework_assistance_run = await self.create_homework_assistance_run(
+                request=CreateHomeworkAssistantRunRequest(
+                    file_id=media.id,
+                    user_id=user_id,
+                ),
+                session=session,
+                state=HomeworkAssistanceRunState.AWAITING_UPLOAD,
+                medias=[media],
+            )
+            homework_assistance_run_ids.append(homework_assistance_run.id)
+
+        homework_batch = HomeworkBatch(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            run_ids=homework_assistance_run_ids,
+        )
+        session.add(homework_batch)
+        return homework_batch
+
+    async def complete_batch_uploads(self, session: AsyncSession, uploaded_run_ids: list[str], failed_run_ids: list[str]) -> list[HomeworkAssistanceRun]:
+        snapshot_service = SnapshotService()
+        if failed_run_ids:
+            await session.execute(
+                update(Media).where(Media.run_id.in_(failed_run_ids)).values(state=MediaUploadState.FAILED)
+            )
+            await session.execute(
+                update(HomeworkAssistanceRun)
+                .where(HomeworkAssistanceRun.id.in_(failed_run_ids))
+                .values(state=HomeworkAssistanceRunState.FAILED)
+            )
+            await snapshot_service.set_media_state(session=session, run_ids=failed_run_ids, state=MediaUploadState.FAILED)
+            await snapshot_service.update(session=session, run_ids=failed_run_ids, state=HomeworkAssistanceRunState.FAILED)
+        if not uploaded_run_ids:
+            await session.commit()
+            return []
+
+        await session.execute(
+            update(Media).where(Media.run_id.in_(uploaded_run_ids)).values(state=MediaUploadState.SUCCESS)
+        )
+        await snapshot_service.set_media_state(session=session, run_ids=uploaded_run_ids, state=MediaUploadState.SUCCESS)
+        # A storage webhook may have started some of the runs already, those are not scheduled twice
+        result = await session.execute(
+            update(HomeworkAssistanceRun)
+            .where(
+                HomeworkAssistanceRun.id.in_(uploaded_run_ids),
+                HomeworkAssistanceRun.state == HomeworkAssistanceRunState.AWAITING_UPLOAD,
+            )
+            .values(state=HomeworkAssistanceRunState.STARTED)
+            .returning(HomeworkAssistanceRun.id)
+        )
+        started_run_ids = list(result.scalars().all())
+        await snapshot_service.update(session=session, run_ids=started_run_ids, state=HomeworkAssistanceRunState.STARTED)
+        await session.commit()
+
+        if not started_run_ids:
+            return []
+        result = await session.execute(
+            select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id.in_(started_run_ids))
+        )
+        return list(result.scalars().all())
+
+    async def get_batch(self, session: AsyncSession, batch_id: str) -> HomeworkBatch | None:
+        result = await session.execute(select(HomeworkBatch).where(HomeworkBatch.id == batch_id))
+        return result.scalar_one_or_none()
+
+    async def get_batch_run_states(self, session: AsyncSession, homework_batch: HomeworkBatch) -> dict[str, str]:
+        result = await session.execute(
+            select(HomeworkAssistanceRun.id, HomeworkAssistanceRun.state).where(
+                HomeworkAssistanceRun.id.in_(homework_batch.run_ids)
+            )
+        )
+        return dict(result.all())
+
+    async def get_cancelled_run_ids(self, session: AsyncSession, run_ids: list[str]) -> list[str]:
+        result = await session.execute(
+            select(HomeworkAssistanceRun.id).where(
+                HomeworkAssistanceRun.id.in_(run_ids),
+                HomeworkAssistanceRun.state == HomeworkAssistanceRunState.CANCELLED,
+            )
+        )
+        return list(result.scalars().all())
+
+    async def complete_upload(self, session: AsyncSession, homework_assistance_run: HomeworkAssistanceRun) -> bool:
+        # The client callback and the storage webhook can both arrive, only the first one starts the run
+        claim = await session.execute(
+            update(HomeworkAssistanceRun)
+            .where(
+                HomeworkAssistanceRun.id == homework_assistance_run.id,
+                HomeworkAssistanceRun.state == HomeworkAssistanceRunState.AWAITING_UPLOAD,
+            )
+            .values(state=HomeworkAssistanceRunState.STARTED)
+        )
+        if claim.rowcount != 1:
+            await session.rollback()
+            return False
+
+        for media in homework_assistance_run.medias:
+            media.state = MediaUploadState.SUCCESS
+        snapshot_service = SnapshotService()
+        await snapshot_service.set_media_state(session=session, run_ids=[homework_assistance_run.id], state=MediaUploadState.SUCCESS)
+        await snapshot_service.update(session=session, run_ids=[homework_assistance_run.id], state=HomeworkAssistanceRunState.STARTED)
+        await session.commit()
+        await session.refresh(homework_assistance_run)
+        return True
+
+    async def cancel_run(self, session: AsyncSession, homework_assistance_run_id: str) -> HomeworkAssistanceRunState | None:
+        result = await session.execute(
+            update(HomeworkAssistanceRun)
+            .where(
+                HomeworkAssistanceRun.id == homework_assistance_run_id,
+                HomeworkAssistanceRun.state.in_([
+                    HomeworkAssistanceRunState.AWAITING_UPLOAD,
+                    HomeworkAssistanceRunState.PENDING,
+                    HomeworkAssistanceRunState.STARTED,
+                ]),
+            )
+            .values(state=HomeworkAssistanceRunState.CANCELLED)
+            .returning(HomeworkAssistanceRun.id)
+        )
+        if result.scalar_one_or_none() is None:
+            # Unknown, already finished or already cancelled
+            result = await session.execute(
+                select(HomeworkAssistanceRun.state).where(HomeworkAssistanceRun.id == homework_assistance_run_id)
+            )
+            state = result.scalar_one_or_none()
+            return HomeworkAssistanceRunState(state) if state is not None else None
+
+        await session.execute(
+            update(HomeworkAssistanceRunStep)
+            .where(
+                HomeworkAssistanceRunStep.run_id == homework_assistance_run_id,
+                HomeworkAssistanceRunStep.state.in_([HomeworkAssistanceRunStepState.PENDING, HomeworkAssistanceRunStepState.STARTED]),
+            )
+            .values(state=HomeworkAssistanceRunStepState.CANCELLED)
+        )
+        result = await session.execute(
+            select(HomeworkAssistanceRunStep.step_name, HomeworkAssistanceRunStep.state)
+            .where(HomeworkAssistanceRunStep.run_id == homework_assistance_run_id)
+        )
+        await SnapshotService().update(
+            session=session,
+            run_ids=[homework_assistance_run_id],
+            state=HomeworkAssistanceRunState.CANCELLED,
+            steps=dict(result.all()),
+        )
+        # Delivered on commit, the worker running the run aborts it
+        await session.execute(select(func.pg_notify(RUN_CANCELLED_CHANNEL, homework_assistance_run_id)))
+        await session.commit()
+        return HomeworkAssistanceRunState.CANCELLED
+
+    async def hand_back_run(self, session: AsyncSession, homework_assistance_run_id: str) -> None:
+        result = await session.execute(
+            update(HomeworkAssistanceRun)
+            .where(
+                HomeworkAssistanceRun.id == homework_assistance_run_id,
+                HomeworkAssistanceRun.state == HomeworkAssistanceRunState.STARTED,
+            )
+            .values(state=HomeworkAssistanceRunState.PENDING)
+        )
+        if result.rowcount == 1:
+            await SnapshotService().update(session=session, run_ids=[homework_assistance_run_id], state=HomeworkAssistanceRunState.PENDING)
+            await session.execute(select(func.pg_notify(RUN_HANDED_BACK_CHANNEL, homework_assistance_run_id)))
+        await session.commit()
+
+    async def claim_handed_back_runs(self, session: AsyncSession, run_ids: list[str] | None = None) -> list[HomeworkAssistanceRun]:
+        query = select(HomeworkAssistanceRun.id).where(HomeworkAssistanceRun.state == HomeworkAssistanceRunState.PENDING)
+        if run_ids is not None:
+            query = query.where(HomeworkAssistanceRun.id.in_(run_ids))
+        result = await session.execute(query)
+        claimed = []
+        for run_id in result.scalars().all():
+            # Several workers start at once during a deploy, only the one whose update matches resumes the run
+            claim = await session.execute(
+                update(HomeworkAssistanceRun)
+                .where(
+                    HomeworkAssistanceRun.id == run_id,
+                    HomeworkAssistanceRun.state == HomeworkAssistanceRunState.PENDING,
+                )
+                .values(state=HomeworkAssistanceRunState.STARTED)
+            )
+            if claim.rowcount == 1:
+                claimed.append(run_id)
+        await SnapshotService().update(session=session, run_ids=claimed, state=HomeworkAssistanceRunState.STARTED)
+        await session.commit()
+
+        if not claimed:
+            return []
+        result = await session.execute(
+            select(HomeworkAssistanceRun).where(HomeworkAssistanceRun.id.in_(claimed))
+        )
+        return list(result.scalars().all())
+
+    async def get_runs_with_extraction_artifacts(self, session: AsyncSession, since: datetime.datetime | None = None) -> list[str]:
+        query = select(LlmArtifact.run_id).where(LlmArtifact.source == LlmUsageSource.EXTRACT_TASKS).distinct()
+        if since is not None:
+            query = query.where(LlmArtifact.created_at >= since)
+        result = await session.execute(query)
+        return list(result.scalars().all())
+
+    async def reparse_tasks(self, session: AsyncSession, supabase_client, homework_assistance_run_id: str) -> list[Task] | None:
+        # Rebuilds the tasks from the stored model output, so a parser fix does not need another LLM call
+        artifact_service = ArtifactService()
+        llm_artifact = await artifact_service.get_latest_artifact(
+            session=session, run_id=homework_assistance_run_id, source=LlmUsageSource.EXTRACT_TASKS
+        )
+        if llm_artifact is None:
+            return None
+        output = await artifact_service.read_artifact(supabase_client=supabase_client, llm_artifact=llm_artifact)
+
+        task_xmls, _ = split_tasks(output)
+        tasks = [task for task in (parse_task(task_xml, run_id=homework_assistance_run_id) for task_xml in task_xmls) if task]
+        await session.execute(delete(Task).where(Task.run_id == homework_assistance_run_id))
+        session.add_all(tasks)
+        await SnapshotService().update(
+            session=session, run_ids=[homework_assistance_run_id], tasks=[task_document(task) for task in tasks]
+        )
+        return tasks
+
     async def get_run(self, session: AsyncSession, homework_assistance_run_id: str) -> HomeworkAssistanceRun:
         result = await session.execute(
             select(HomeworkAssistanceRun).where(
@@ -312,29 +891,69 @@ class HomeworkService:
             raise ValueError(f"No run found with id: {homework_assistance_run_id}")
         return run
 
-    async def on_chat_message(self, session: AsyncSession, homework_assistance_run_id: str, messages: list[Message]):
-        client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY_OPENAI"))
-
+    async def get_run_by_media_path(self, session: AsyncSession, path: str) -> HomeworkAssistanceRun | None:
+        result = await session.execute(
+            select(HomeworkAssistanceRun).join(Media, Media.run_id == HomeworkAssistanceRun.id).where(Media.path == path)
+        )
+        return result.scalar_one_or_none()
+
+    async def on_chat_message(self, session: AsyncSession, homework_assistance_run_id: str, messages: list[Message]) -> AsyncIterator[str]:
+        # Checked before the response starts, an unknown run is a 404 instead of a broken stream
+        run = await self.get_run(session=session, homework_assistance_run_id=homework_assistance_run_id)
+        run_id, user_id = run.id, run.user_id
+        remaining_budget = await UsageService().get_remaining_budget(session=session, user_id=user_id, run_id=run_id)
+        # Ends the transaction so the connection goes back to the pool instead of staying with the stream
+        await session.rollback()
+        return self._stream_chat(run_id=run_id, user_id=user_id, messages=messages, remaining_budget=remaining_budget)
+
+    async def _stream_chat(self, run_id: str, user_id: str, messages: list[Message], remaining_budget: float) -> AsyncIterator[str]:
         print("----")
         for message in messages:
             print(message.model_dump())
         print("---")
 
+        usage = TokenUsage(prompt_tokens=sum(estimate_text_tokens(message.content) for message in messages))
+        if estimate_cost(CHAT_MODEL, usage.prompt_tokens, EXPECTED_CHAT_COMPLETION_TOKENS) > remaining_budget:
+            yield "\n[ERROR]: Usage budget exceeded"
+            return
+
+        completion = []
         try:
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
+            async for content in stream_chat_completion(
+                model=CHAT_MODEL,
                 messages=[message.model_dump() for message in messages],
-                stream=True,
-            )
-            async for chunk in response:
-                if (
-                    hasattr(chunk.choices[0], "delta")
-                    and hasattr(chunk.choices[0].delta, "content")
-                    and chunk.choices[0].delta.content
-                ):
-                    yield chunk.choices[0].delta.content
+                operation="chat",
+                usage=usage,
+                priority=PRIORITY_INTERACTIVE,
+                expected_completion_tokens=EXPECTED_CHAT_COMPLETION_TOKENS,
+            ):
+                completion.append(content)
+                yield content
         except Exception as e:
             yield f"\n[ERROR]: {str(e)}"
+        finally:
+            # The request scoped session is closed once the response streams, so use a fresh one
+            async with sessionmanager.session() as usage_session:
+                if usage.prompt_tokens or usage.completion_tokens:
+                    await UsageService().record_usage(
+                        session=usage_session,
+                        run_id=run_id,
+                        user_id=user_id,
+                        source=LlmUsageSource.CHAT,
+                        model=CHAT_MODEL,
+                        usage=usage,
+                    )
+                # Kept even when the client disconnected, the partial answer is what the user saw
+                await ArtifactService().record_artifact(
+                    session=usage_session,
+                    run_id=run_id,
+                    user_id=user_id,
+                    source=LlmUsageSource.CHAT,
+                    model=CHAT_MODEL,
+                    output="".join(completion),
+                    details={"messages": len(messages)},
+                )
+                await usage_session.commit()
 
     async def get_homework_assistant_run_steps_states(self, homework_assistance_run_id: str, session: AsyncSession) -> GetHomeworkAssistanceRunStatusResponse:
         result = await session.execute(
@@ -0,0 +1,125 @@
+import datetime
+
+from sqlalchemy import ColumnElement, String, cast, func, literal, select, update
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import HomeworkAssistanceRun, HomeworkAssistanceRunSnapshot, Media, Task
+
+# The snapshot is a denormalized copy of a run graph that the views read with one primary-key lookup.
+# Writers keep it current in the same transaction as their own change, mostly with in-place JSONB edits.
+
+
+def task_document(task: Task) -> dict:
+    return {
+        "id": task.id,
+        "key": task.key,
+        "description": task.description,
+        "concepts": task.concepts,
+    }
+
+
+def media_document(media: Media) -> dict:
+    return {
+        "id": media.id,
+        "path": media.path,
+        "state": media.state,
+    }
+
+
+class SnapshotService:
+    @staticmethod
+    def build(run: HomeworkAssistanceRun, medias: list[Media] | None = None, tasks: list[Task] | None = None) -> dict:
+        return {
+            "homework_assistance_run_id": run.id,
+            "user_id": run.user_id,
+            "state": run.state,
+            "labels": run.labels or [],
+            "explanation": run.explanation,
+            "steps": {step.step_name: step.state or "PENDING" for step in run.steps},
+            "tasks": [task_document(task) for task in (run.tasks if tasks is None else tasks)],
+            "medias": [media_document(media) for media in (run.medias if medias is None else medias)],
+        }
+
+    def create(self, session: AsyncSession, run: HomeworkAssistanceRun, medias: list[Media]) -> HomeworkAssistanceRunSnapshot:
+        # Called before the run is flushed, its collections are empty and must not be lazy loaded
+        snapshot = HomeworkAssistanceRunSnapshot(
+            run_id=run.id,
+            document=self.build(run, medias=medias, tasks=[]),
+        )
+        session.add(snapshot)
+        return snapshot
+
+    async def save(self, session: AsyncSession, run: HomeworkAssistanceRun) -> dict:
+        document = self.build(run)
+        statement = insert(HomeworkAssistanceRunSnapshot).values(run_id=run.id, document=document, version=1)
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[HomeworkAssistanceRunSnapshot.run_id],
+                set_={
+                    "document": statement.excluded.document,
+                    "version": HomeworkAssistanceRunSnapshot.version + 1,
+                    "updated_at": func.now(),
+                },
+            )
+        )
+        return document
+
+    async def get(self, session: AsyncSession, run_id: str) -> HomeworkAssistanceRunSnapshot | None:
+        result = await session.execute(
+            select(HomeworkAssistanceRunSnapshot).where(HomeworkAssistanceRunSnapshot.run_id == run_id)
+        )
+        return result.scalar_one_or_none()
+
+    async def _apply(self, session: AsyncSession, run_ids: list[str], document: ColumnElement) -> None:
+        if not run_ids:
+            return
+        await session.execute(
+            update(HomeworkAssistanceRunSnapshot)
+            .where(HomeworkAssistanceRunSnapshot.run_id.in_(run_ids))
+            .values(
+                document=document,
+                version=HomeworkAssistanceRunSnapshot.version + 1,
+                updated_at=datetime.datetime.now(datetime.timezone.utc),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def _set(path: list[str], value) -> ColumnElement:
+        return func.jsonb_set(
+            HomeworkAssistanceRunSnapshot.document,
+            cast(literal(path, ARRAY(String)), ARRAY(String)),
+            literal(value, JSONB),
+        )
+
+    async def update(self, session: AsyncSession, run_ids: list[str], **fields) -> None:
+        await self._apply(session, run_ids, HomeworkAssistanceRunSnapshot.document.op("||")(literal(fields, JSONB)))
+
+    async def set_step_state(self, session: AsyncSession, run_id: str, step_name: str, state: str) -> None:
+        await self._apply(session, [run_id], self._set(["steps", step_name], state))
+
+    async def append_task(self, session: AsyncSession, run_id: str, task: Task) -> None:
+        tasks = HomeworkAssistanceRunSnapshot.document["tasks"].op("||")(literal([task_document(task)], JSONB))
+        await self._apply(session, [run_id], func.jsonb_set(
+            HomeworkAssistanceRunSnapshot.document,
+            cast(literal(["tasks"], ARRAY(String)), ARRAY(String)),
+            tasks,
+        ))
+
+    async def set_media_state(self, session: AsyncSession, run_ids: list[str], state: str) -> None:
+        # Every run has a single media today, set the state on all of them to stay correct if that changes
+        media = func.jsonb_array_elements(HomeworkAssistanceRunSnapshot.document["medias"]).table_valued("value").alias("media")
+        medias = (
+            select(func.coalesce(
+                func.jsonb_agg(media.c.value.op("||")(literal({"state": state}, JSONB))),
+                literal([], JSONB),
+            ))
+            .select_from(media)
+            .scalar_subquery()
+        )
+        await self._apply(session, run_ids, func.jsonb_set(
+            HomeworkAssistanceRunSnapshot.document,
+            cast(literal(["medias"], ARRAY(String)), ARRAY(String)),
+            medias,
+        ))
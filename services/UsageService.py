@@ -0,0 +1,93 @@
+import datetime
+import os
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import LlmUsage
+from request_models import UsageBreakdown, UsageSummaryResponse
+from utils.llm import TokenUsage, estimate_cost
+
+RUN_BUDGET_USD = float(os.environ.get("RUN_BUDGET_USD", "0.25"))
+USER_DAILY_BUDGET_USD = float(os.environ.get("USER_DAILY_BUDGET_USD", "5.00"))
+
+
+def start_of_day() -> datetime.datetime:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class UsageService:
+    async def record_usage(self, session: AsyncSession, run_id: str, user_id: str, source: str, model: str, usage: TokenUsage) -> LlmUsage:
+        llm_usage = LlmUsage(
+            run_id=run_id,
+            user_id=user_id,
+            source=source,
+            model=model,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            cost_usd=estimate_cost(model, usage.prompt_tokens, usage.completion_tokens),
+            estimated=usage.estimated,
+        )
+        session.add(llm_usage)
+        return llm_usage
+
+    async def get_run_spend(self, session: AsyncSession, run_id: str) -> float:
+        result = await session.execute(
+            select(func.coalesce(func.sum(LlmUsage.cost_usd), 0.0)).where(LlmUsage.run_id == run_id)
+        )
+        return result.scalar_one()
+
+    async def get_user_spend(self, session: AsyncSession, user_id: str, since: datetime.datetime) -> float:
+        result = await session.execute(
+            select(func.coalesce(func.sum(LlmUsage.cost_usd), 0.0)).where(
+                LlmUsage.user_id == user_id,
+                LlmUsage.created_at >= since,
+            )
+        )
+        return result.scalar_one()
+
+    async def get_remaining_budget(self, session: AsyncSession, user_id: str, run_id: str) -> float:
+        run_spend = await self.get_run_spend(session=session, run_id=run_id)
+        user_spend = await self.get_user_spend(session=session, user_id=user_id, since=start_of_day())
+        return max(0.0, min(RUN_BUDGET_USD - run_spend, USER_DAILY_BUDGET_USD - user_spend))
+
+    async def get_usage_summary(self, session: AsyncSession, user_id: str | None = None, run_id: str | None = None, since: datetime.datetime | None = None) -> UsageSummaryResponse:
+        conditions = []
+        if user_id is not None:
+            conditions.append(LlmUsage.user_id == user_id)
+        if run_id is not None:
+            conditions.append(LlmUsage.run_id == run_id)
+        if since is not None:
+            conditions.append(LlmUsage.created_at >= since)
+
+        result = await session.execute(
+            select(
+                LlmUsage.model,
+                LlmUsage.source,
+                func.count(LlmUsage.id),
+                func.sum(LlmUsage.prompt_tokens),
+                func.sum(LlmUsage.completion_tokens),
+                func.sum(LlmUsage.cost_usd),
+            ).where(*conditions).group_by(LlmUsage.model, LlmUsage.source)
+        )
+        breakdown = [
+            UsageBreakdown(
+                model=model,
+                source=source,
+                calls=calls,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cost_usd=cost_usd,
+            )
+            for model, source, calls, prompt_tokens, completion_tokens, cost_usd in result.all()
+        ]
+        return UsageSummaryResponse(
+            user_id=user_id,
+            homework_assistance_run_id=run_id,
+            since=since,
+            prompt_tokens=sum(item.prompt_tokens for item in breakdown),
+            completion_tokens=sum(item.completion_tokens for item in breakdown),
+            cost_usd=sum(item.cost_usd for item in breakdown),
+            breakdown=breakdown,
+        )
@@ -0,0 +1,37 @@
+import io
+import os
+import zipfile
+
+BULK_MAX_FILES = int(os.environ.get("BULK_MAX_FILES", "100"))
+BULK_MAX_BYTES = int(os.environ.get("BULK_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def is_zip(filename: str, contents: bytes) -> bool:
+    return filename.lower().endswith(".zip") and zipfile.is_zipfile(io.BytesIO(contents))
+
+
+def unpack_zip(contents: bytes) -> list[tuple[str, bytes]]:
+    files = []
+    total_size = 0
+    with zipfile.ZipFile(io.BytesIO(contents)) as archive:
+        for info in archive.infolist():
+            name = os.path.basename(info.filename)
+            # Folders and metadata macOS adds to archives are not worksheets
+            if info.is_dir() or not name or name.startswith(".") or info.filename.startswith("__MACOSX/"):
+                continue
+            if len(files) == BULK_MAX_FILES:
+                raise ArchiveError(f"Archive contains more than {BULK_MAX_FILES} files")
+            # Checked against the declared size before extracting, so a zip bomb is never inflated
+            total_size += info.file_size
+            if total_size > BULK_MAX_BYTES:
+                raise ArchiveError(f"Archive is larger than {BULK_MAX_BYTES} bytes uncompressed")
+            with archive.open(info) as file:
+                data = file.read(info.file_size + 1)
+            if len(data) > info.file_size:
+                raise ArchiveError(f"{info.filename} is larger than its declared size")
+            files.append((name, data))
+    return files
@@ -0,0 +1,134 @@
+import contextlib
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+
+BLOB_CACHE_DIR = os.environ.get("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "impehrium-blobs"))
+BLOB_CACHE_MAX_BYTES = int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+class BlobCache:
+    """Size-bounded on-disk cache of immutable blobs, keyed by their SHA-256.
+
+    Blobs live in ``blobs/`` under their digest, ``keys/`` maps a storage path to
+    the digest of its contents. The cache directory may be shared by all workers
+    on a host, so recency is kept in the files' mtimes rather than in memory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: int | None = None
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def _key_path(self, key: str) -> str:
+        return os.path.join(self.directory, "keys", hashlib.sha256(key.encode()).hexdigest())
+
+    @staticmethod
+    def _write_atomically(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, data: bytes, key: str | None = None) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if os.path.exists(blob_path):
+            os.utime(blob_path)
+        else:
+            self._write_atomically(blob_path, data)
+            self._grow(len(data))
+        if key is not None:
+            self._write_atomically(self._key_path(key), digest.encode())
+        return digest
+
+    def digest_for(self, key: str) -> str | None:
+        try:
+            with open(self._key_path(key), "rb") as file:
+                return file.read().decode()
+        except FileNotFoundError:
+            return None
+
+    def get(self, digest: str) -> mmap.mmap | None:
+        blob_path = self._blob_path(digest)
+        try:
+            with open(blob_path, "rb") as file:
+                # mmap fails on empty files, those are never worth caching anyway
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(blob_path)
+        except FileNotFoundError:
+            # Evicted by this or another worker
+            return None
+        return data
+
+    def get_by_key(self, key: str) -> mmap.mmap | None:
+        digest = self.digest_for(key)
+        return self.get(digest) if digest else None
+
+    def _grow(self, size: int) -> None:
+        with self._lock:
+            if self._size is None:
+                self._size = sum(blob_size for _, _, blob_size in self._blobs())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _blobs(self) -> list[tuple[str, float, int]]:
+        root = os.path.join(self.directory, "blobs")
+        blobs = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((path, stat.st_mtime, stat.st_size))
+        return blobs
+
+    def _evict(self) -> None:
+        # Rescan instead of trusting self._size, other workers write to the same directory
+        blobs = sorted(self._blobs(), key=lambda blob: blob[1])
+        size = sum(blob_size for _, _, blob_size in blobs)
+        # Evict down to 90% so a burst of uploads does not rescan on every put
+        target = self.max_bytes * 0.9
+        for path, _, blob_size in blobs:
+            if size <= target:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            size -= blob_size
+        self._size = size
+        self._remove_dangling_keys()
+
+    def _remove_dangling_keys(self) -> None:
+        keys = os.path.join(self.directory, "keys")
+        if not os.path.isdir(keys):
+            return
+        for entry in os.scandir(keys):
+            if entry.name.startswith(".tmp-"):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                with open(entry.path, "rb") as file:
+                    digest = file.read().decode()
+                if not os.path.exists(self._blob_path(digest)):
+                    os.unlink(entry.path)
+
+
+blob_cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES)
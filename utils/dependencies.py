@@ -1,6 +1,8 @@
 import os
 
 from services.HomeworkService import HomeworkService
+from services.SnapshotService import SnapshotService
+from services.UsageService import UsageService
 from services.UserService import UserService
 
 
@@ -12,3 +14,9 @@ def get_homework_service() -> HomeworkService:
     return HomeworkService()
 
 
+def get_usage_service() -> UsageService:
+    return UsageService()
+
+
+def get_snapshot_service() -> SnapshotService:
+    return SnapshotService()
@@ -0,0 +1,76 @@
+import base64
+import mmap
+from dataclasses import dataclass
+from io import BytesIO
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL.Image import Image
+
+# PIL and pdf2image are imported on first use, they are only needed by the extraction step
+
+
+def preload() -> None:
+    import PIL.Image
+    import pdf2image
+
+    PIL.Image.init()
+
+
+def rasterize_first_page(data: bytes | mmap.mmap, file_extension: str, dpi: int = 300) -> "Image":
+    if file_extension == ".pdf":
+        from pdf2image import convert_from_bytes
+
+        return convert_from_bytes(bytes(data), dpi=dpi, first_page=1, last_page=1)[0]
+
+    from PIL import Image
+
+    # A memory-mapped blob is already a seekable file, PIL decodes it without copying it into memory first
+    stream = data if isinstance(data, mmap.mmap) else BytesIO(data)
+    return Image.open(stream).convert("RGB")
+
+
+def count_pages(data: bytes | mmap.mmap, file_extension: str) -> int:
+    if file_extension != ".pdf":
+        return 1
+    from pdf2image import pdfinfo_from_bytes
+
+    return int(pdfinfo_from_bytes(bytes(data)).get("Pages", 1))
+
+
+@dataclass
+class PageSignals:
+    page_count: int
+    # Share of dark pixels, how much of the page is covered by writing or drawings
+    ink_density: float
+    # Share of pixels on an edge, many small glyphs produce far more edges than a few large ones
+    edge_density: float
+    # Grayscale histogram entropy in bits, photos score high, clean scans and exports low
+    entropy: float
+
+
+def measure_page(image: "Image", page_count: int = 1, sample_side: int = 512) -> PageSignals:
+    from PIL import ImageFilter, ImageOps
+
+    # A small grayscale copy is enough for these statistics and keeps them in the low milliseconds
+    sample = image.convert("L")
+    sample.thumbnail((sample_side, sample_side))
+    pixel_count = sample.width * sample.height
+    # Autocontrast first so the ink threshold also holds for dim phone photos
+    ink_pixels = ImageOps.autocontrast(sample, cutoff=1).histogram()[:128]
+    edge_pixels = sample.filter(ImageFilter.FIND_EDGES).histogram()[64:]
+    return PageSignals(
+        page_count=page_count,
+        ink_density=sum(ink_pixels) / pixel_count,
+        edge_density=sum(edge_pixels) / pixel_count,
+        entropy=sample.entropy(),
+    )
+
+
+def encode_image(image: "Image", image_format: str = "png") -> str:
+    buffered = BytesIO()
+    if image_format == "jpeg":
+        image.save(buffered, format="JPEG", quality=85, optimize=True)
+    else:
+        image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+from typing import Coroutine
+
+# Counted from the shutdown signal and shared with uvicorn's graceful timeout, not added on top of it
+STEP_DRAIN_TIMEOUT = float(os.environ.get("STEP_DRAIN_TIMEOUT", "20"))
+# Time cancelled steps get to hand their run back once the drain timeout is over
+HAND_BACK_TIMEOUT = 5
+DRAIN_RETRY_AFTER_SECONDS = 5
+# Postgres NOTIFY channels carrying run ids to every worker
+RUN_CANCELLED_CHANNEL = "homework_run_cancelled"
+RUN_HANDED_BACK_CHANNEL = "homework_run_handed_back"
+
+_draining = False
+_drain_deadline: float | None = None
+_in_flight: set[asyncio.Task] = set()
+_run_tasks: dict[str, set[asyncio.Task]] = {}
+_cancelled_runs: set[str] = set()
+
+
+def is_draining() -> bool:
+    return _draining
+
+
+def start_draining() -> None:
+    global _draining, _drain_deadline
+    _draining = True
+    if _drain_deadline is None:
+        _drain_deadline = time.monotonic() + STEP_DRAIN_TIMEOUT
+
+
+def install_drain_signal_handlers() -> None:
+    # uvicorn installs its own SIGINT/SIGTERM handlers before lifespan startup, chain onto them so
+    # the worker stops accepting new runs as soon as the signal arrives, not only once HTTP drained
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            start_draining()
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+
+def track_current_task() -> asyncio.Task:
+    task = asyncio.current_task()
+    _in_flight.add(task)
+    return task
+
+
+def untrack_task(task: asyncio.Task) -> None:
+    _in_flight.discard(task)
+
+
+def spawn(coroutine: Coroutine, run_id: str | None = None) -> asyncio.Task:
+    task = asyncio.create_task(coroutine)
+    _in_flight.add(task)
+    task.add_done_callback(_in_flight.discard)
+    if run_id is not None:
+        _run_tasks.setdefault(run_id, set()).add(task)
+        task.add_done_callback(lambda task: _forget_run_task(run_id, task))
+    return task
+
+
+def _forget_run_task(run_id: str, task: asyncio.Task) -> None:
+    tasks = _run_tasks.get(run_id)
+    if tasks is None:
+        return
+    tasks.discard(task)
+    if not tasks:
+        del _run_tasks[run_id]
+        _cancelled_runs.discard(run_id)
+
+
+def cancel_run(run_id: str) -> bool:
+    # Every worker hears about every cancellation, only the one working on the run has tasks for it
+    # The worker that took the cancel request hears its own NOTIFY too, the second call is a no-op
+    tasks = _run_tasks.get(run_id)
+    if not tasks:
+        return False
+    if run_id in _cancelled_runs:
+        return True
+    _cancelled_runs.add(run_id)
+    for task in tasks:
+        if not task.cancelling():
+            task.cancel()
+    return True
+
+
+def running_run_ids() -> list[str]:
+    return list(_run_tasks)
+
+
+def is_run_cancelled(run_id: str) -> bool:
+    return run_id in _cancelled_runs
+
+
+async def drain() -> None:
+    start_draining()
+    if not _in_flight:
+        return
+    # Steps kept running while uvicorn waited for open requests, they only get what is left of the deadline
+    _, pending = await asyncio.wait(set(_in_flight), timeout=max(0.0, _drain_deadline - time.monotonic()))
+    # Cancelled steps hand their work back before they finish, wait for that to happen. Steps a user
+    # cancelled already are left alone, their cleanup runs in tasks spawned from the step
+    for task in pending:
+        if not task.cancelling():
+            task.cancel()
+    hand_back_deadline = time.monotonic() + HAND_BACK_TIMEOUT
+    while remaining := {task for task in _in_flight if not task.done()}:
+        timeout = hand_back_deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        await asyncio.wait(remaining, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
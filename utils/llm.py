@@ -0,0 +1,378 @@
+import asyncio
+import math
+import os
+import random
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator
+
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+from utils.metrics import (
+    LLM_CIRCUIT_REJECTIONS,
+    LLM_DURATION,
+    LLM_HEDGES,
+    LLM_RETRIES,
+    LLM_STREAMS_IN_FLIGHT,
+    LLM_TIME_TO_FIRST_TOKEN,
+    LLM_TOKENS,
+)
+from utils.rate_limit import PRIORITY_BACKGROUND, rate_limiter
+from utils.tracing import tracer
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# USD per one million tokens
+MODEL_PRICING: dict[str, tuple[float, float]] = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# Vision input is billed as base tokens plus tokens per 512px tile, the mini model bills far more tokens per image
+IMAGE_TOKENS: dict[str, tuple[int, int]] = {
+    "gpt-4o": (85, 170),
+    "gpt-4o-mini": (2833, 5667),
+}
+
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+# Covers connecting, the request and waiting for the first content token, vision prompts are slow to start
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT", "30"))
+LLM_INTER_TOKEN_TIMEOUT = float(os.environ.get("LLM_INTER_TOKEN_TIMEOUT", "15"))
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = 8.0
+# Comma separated operations that race a second request once the first is slower than the p95 time
+# to first token, e.g. "chat". Off by default, a hedged request is billed for its prompt as well.
+LLM_HEDGED_OPERATIONS = {operation for operation in os.environ.get("LLM_HEDGED_OPERATIONS", "").split(",") if operation}
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_MIN_DELAY = 0.25
+LLM_LATENCY_WINDOW = 200
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+
+_client: "AsyncOpenAI | None" = None
+
+
+class LlmError(Exception):
+    pass
+
+
+class LlmTimeoutError(LlmError):
+    pass
+
+
+class LlmUnavailableError(LlmError):
+    pass
+
+
+class CircuitBreaker:
+    """Fails calls fast once a model kept failing, then lets one probe through per cooldown.
+
+    State is per worker process, every worker finds out on its own that the provider is degraded.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        # Half open, this call probes the provider while the others keep failing fast until it reports back
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+_breakers: dict[str, CircuitBreaker] = defaultdict(lambda: CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN))
+_first_token_latencies: dict[tuple[str, str], deque[float]] = defaultdict(lambda: deque(maxlen=LLM_LATENCY_WINDOW))
+
+
+def is_transient(error: BaseException) -> bool:
+    import openai
+
+    return isinstance(error, (LlmTimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+
+@dataclass
+class TokenUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimated: bool = True
+
+
+def get_openai_client() -> "AsyncOpenAI":
+    global _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI
+
+        # Retries are done by stream_chat_completion, which also knows about streams stalling after they started
+        _client = AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY_OPENAI"),
+            timeout=httpx.Timeout(LLM_FIRST_TOKEN_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            max_retries=0,
+        )
+    return _client
+
+
+def estimate_text_tokens(text: str) -> int:
+    try:
+        import tiktoken
+    except ImportError:
+        return math.ceil(len(text) / 4)
+    return len(tiktoken.get_encoding("o200k_base").encode(text))
+
+
+def estimate_image_tokens(model: str, width: int, height: int, detail: str = "high") -> int:
+    base, per_tile = IMAGE_TOKENS[model]
+    if detail == "low":
+        return base
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return base + per_tile * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICING[model]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def _has_content(chunk) -> bool:
+    return bool(chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content)
+
+
+async def _settle(model: str, charged_tokens: float, used_tokens: int) -> None:
+    try:
+        await rate_limiter.settle(model, charged_tokens, used_tokens)
+    except Exception as e:
+        print(f"Settling rate limit tokens for {model} failed: {e}")
+
+
+async def _open_stream(client: "AsyncOpenAI", model: str, operation: str, messages: list[dict], tokens: int, priority: int):
+    # Returns the stream together with the chunks read up to the first one carrying content and the
+    # tokens charged to the rate limiter, a request only counts as started once the provider
+    # actually produces tokens
+    charged_tokens = await rate_limiter.acquire(model, tokens=tokens, priority=priority)
+    started = time.perf_counter()
+    response = None
+    buffered = []
+    try:
+        async with asyncio.timeout(LLM_FIRST_TOKEN_TIMEOUT):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            iterator = aiter(response)
+            async for chunk in iterator:
+                buffered.append(chunk)
+                if _has_content(chunk):
+                    break
+    except TimeoutError:
+        if response is not None:
+            await response.close()
+        raise LlmTimeoutError(f"No first token from {model} within {LLM_FIRST_TOKEN_TIMEOUT:g}s") from None
+    except asyncio.CancelledError:
+        if response is not None:
+            await response.close()
+        # Abandoned before any tokens came back, e.g. the losing hedge, nothing is left to bill
+        await _settle(model, charged_tokens, 0)
+        raise
+    except BaseException:
+        if response is not None:
+            await response.close()
+        raise
+    _first_token_latencies[(model, operation)].append(time.perf_counter() - started)
+    return response, iterator, buffered, charged_tokens
+
+
+def _hedge_delay(model: str, operation: str) -> float | None:
+    if operation not in LLM_HEDGED_OPERATIONS:
+        return None
+    latencies = sorted(_first_token_latencies[(model, operation)])
+    if len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return max(LLM_HEDGE_MIN_DELAY, latencies[int(len(latencies) * 0.95) - 1])
+
+
+async def _open_hedged_stream(
+    client: "AsyncOpenAI", model: str, operation: str, messages: list[dict], tokens: int, priority: int, prompt_tokens: int
+):
+    delay = _hedge_delay(model, operation)
+    if delay is None:
+        return await _open_stream(client, model, operation, messages, tokens, priority)
+
+    primary = asyncio.create_task(_open_stream(client, model, operation, messages, tokens, priority))
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return primary.result()
+
+        # The first request is slower than 95% of recent ones, race a second one against it
+        hedge = asyncio.create_task(_open_stream(client, model, operation, messages, tokens, priority))
+        pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                LLM_HEDGES.labels(model=model, operation=operation, winner="hedge" if task is hedge else "primary").inc()
+                for other in done - {task}:
+                    if other.exception() is None:
+                        response, _, buffered, charged_tokens = other.result()
+                        await response.close()
+                        # The loser was billed its prompt and whatever it streamed before being closed
+                        content = "".join(chunk.choices[0].delta.content for chunk in buffered if _has_content(chunk))
+                        await _settle(model, charged_tokens, prompt_tokens + estimate_text_tokens(content))
+                return task.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _retry_delay(attempt: int) -> float:
+    # Full jitter, callers that failed together do not retry together
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+async def stream_chat_completion(
+    model: str,
+    messages: list[dict],
+    operation: str,
+    usage: TokenUsage | None = None,
+    priority: int = PRIORITY_BACKGROUND,
+    expected_completion_tokens: int = 0,
+) -> AsyncIterator[str]:
+    client = get_openai_client()
+    usage = usage if usage is not None else TokenUsage()
+    # Charged to the rate limiter per request and settled against the real usage at the end
+    reserved_tokens = usage.prompt_tokens + expected_completion_tokens
+    charged_tokens = 0
+    breaker = _breakers[model]
+    started = time.perf_counter()
+    first_token_at = None
+    completion = []
+    reported_usage = None
+    response = None
+    outcome = "error"
+    in_flight = LLM_STREAMS_IN_FLIGHT.labels(model=model, operation=operation)
+    in_flight.inc()
+    # Not attached as the current span, an async generator may be closed from another context
+    span = tracer.start_span(
+        f"llm.{operation}",
+        kind=SpanKind.CLIENT,
+        attributes={"llm.model": model, "llm.operation": operation},
+    )
+    try:
+        attempt = 1
+        while True:
+            if not breaker.allow():
+                LLM_CIRCUIT_REJECTIONS.labels(model=model, operation=operation).inc()
+                raise LlmUnavailableError(f"{model} is failing, not calling it for now")
+            try:
+                response, iterator, buffered, charged_tokens = await _open_hedged_stream(
+                    client, model, operation, messages, reserved_tokens, priority, usage.prompt_tokens
+                )
+                break
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                breaker.record_failure()
+                if attempt >= LLM_MAX_ATTEMPTS:
+                    raise
+                LLM_RETRIES.labels(model=model, operation=operation, reason=type(e).__name__).inc()
+                span.add_event("retry", {"attempt": attempt, "error": str(e)})
+                await asyncio.sleep(_retry_delay(attempt))
+                attempt += 1
+        breaker.record_success()
+        span.set_attribute("llm.attempts", attempt)
+
+        # Once content reached the caller the call cannot be repeated, a stall from here on fails it
+        while True:
+            if buffered:
+                chunk = buffered.pop(0)
+            else:
+                try:
+                    async with asyncio.timeout(LLM_INTER_TOKEN_TIMEOUT):
+                        chunk = await anext(iterator)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    breaker.record_failure()
+                    raise LlmTimeoutError(f"{model} stalled for {LLM_INTER_TOKEN_TIMEOUT:g}s mid stream") from None
+                except Exception as e:
+                    if is_transient(e):
+                        breaker.record_failure()
+                    raise
+            if chunk.usage is not None:
+                reported_usage = chunk.usage
+            if not _has_content(chunk):
+                continue
+            content = chunk.choices[0].delta.content
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                LLM_TIME_TO_FIRST_TOKEN.labels(model=model, operation=operation).observe(first_token_at - started)
+                span.add_event("first_token")
+            completion.append(content)
+            yield content
+        outcome = "success"
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR))
+        # Callers handle one error type for a provider that is down, slow or dropped the stream
+        if is_transient(e) and not isinstance(e, LlmError):
+            raise LlmError(f"{model} failed: {e}") from e
+        raise
+    finally:
+        if response is not None:
+            await response.close()
+        in_flight.dec()
+        LLM_DURATION.labels(model=model, operation=operation, outcome=outcome).observe(time.perf_counter() - started)
+        # Without a usage chunk the caller's prompt estimate is kept and the completion is tokenized locally
+        if reported_usage is not None:
+            usage.prompt_tokens = reported_usage.prompt_tokens
+            usage.completion_tokens = reported_usage.completion_tokens
+            usage.estimated = False
+        elif response is None:
+            # The request never got a response, so nothing was billed
+            usage.prompt_tokens = 0
+            usage.completion_tokens = 0
+        else:
+            usage.completion_tokens = estimate_text_tokens("".join(completion))
+            usage.estimated = True
+        LLM_TOKENS.labels(model=model, operation=operation, kind="prompt").inc(usage.prompt_tokens)
+        LLM_TOKENS.labels(model=model, operation=operation, kind="completion").inc(usage.completion_tokens)
+        if response is not None:
+            await _settle(model, charged_tokens, usage.prompt_tokens + usage.completion_tokens)
+        span.set_attributes({
+            "llm.outcome": outcome,
+            "llm.prompt_tokens": usage.prompt_tokens,
+            "llm.completion_tokens": usage.completion_tokens,
+            "llm.usage_estimated": usage.estimated,
+        })
+        span.end()
@@ -0,0 +1,255 @@
+import contextlib
+import contextvars
+import os
+import time
+from typing import Iterator
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.requests import Request
+from starlette.responses import Response
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STEP_DURATION = Histogram(
+    "homework_step_duration_seconds",
+    "Duration of a homework assistance run step",
+    ["step", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+STEPS_IN_FLIGHT = Gauge(
+    "homework_steps_in_flight",
+    "Homework assistance run steps currently executing",
+    ["step"],
+    multiprocess_mode="livesum",
+)
+STEPS_QUEUED = Gauge(
+    "homework_steps_queued",
+    "Homework assistance run steps scheduled but not started yet",
+    ["step"],
+    multiprocess_mode="livesum",
+)
+RUNS_QUEUED = Gauge(
+    "homework_runs_queued",
+    "Homework assistance runs waiting for a run slot",
+    multiprocess_mode="livesum",
+)
+RUNS_RUNNING = Gauge(
+    "homework_runs_running",
+    "Homework assistance runs holding a run slot",
+    multiprocess_mode="livesum",
+)
+RUN_QUEUE_WAIT = Histogram(
+    "homework_run_queue_wait_seconds",
+    "Time a homework assistance run waited for a run slot",
+    buckets=LATENCY_BUCKETS,
+)
+ADMISSION_REJECTIONS = Counter(
+    "homework_admission_rejections_total",
+    "Requests rejected because a user or the worker had too many runs queued",
+    ["limit"],
+)
+
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time until the first streamed content token of an LLM call",
+    ["model", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_DURATION = Histogram(
+    "llm_request_duration_seconds",
+    "Total duration of an LLM call including streaming",
+    ["model", "operation", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens used by LLM calls",
+    ["model", "operation", "kind"],
+)
+LLM_STREAMS_IN_FLIGHT = Gauge(
+    "llm_streams_in_flight",
+    "LLM streams currently open",
+    ["model", "operation"],
+    multiprocess_mode="livesum",
+)
+
+EXTRACTION_ROUTES_TAKEN = Counter(
+    "extraction_routes_total",
+    "Task extraction attempts by routed plan and whether the output was accepted or escalated",
+    ["plan", "outcome"],
+)
+LLM_RETRIES = Counter(
+    "llm_retries_total",
+    "LLM calls retried after a transient failure before the first token",
+    ["model", "operation", "reason"],
+)
+LLM_HEDGES = Counter(
+    "llm_hedges_total",
+    "Hedged LLM requests, by which of the two raced requests produced the first token",
+    ["model", "operation", "winner"],
+)
+LLM_CIRCUIT_REJECTIONS = Counter(
+    "llm_circuit_rejections_total",
+    "LLM calls failed fast because the circuit breaker for the model was open",
+    ["model", "operation"],
+)
+LLM_RATE_LIMIT_WAIT = Histogram(
+    "llm_rate_limit_wait_seconds",
+    "Time an LLM call waited for the provider rate limiter",
+    ["model", "priority"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_RATE_LIMIT_WAITERS = Gauge(
+    "llm_rate_limit_waiters",
+    "LLM calls currently waiting for the provider rate limiter",
+    ["model"],
+    multiprocess_mode="livesum",
+)
+
+STORAGE_DURATION = Histogram(
+    "storage_request_duration_seconds",
+    "Duration of storage requests",
+    ["operation", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+STORAGE_BYTES = Counter(
+    "storage_bytes_total",
+    "Bytes transferred to and from storage",
+    ["operation"],
+)
+
+BLOB_CACHE_LOOKUPS = Counter(
+    "blob_cache_lookups_total",
+    "Local blob cache lookups before falling back to storage",
+    ["result"],
+)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Duration of HTTP requests including background work attached to them",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES = Counter(
+    "db_queries_total",
+    "Database queries executed, by route or background step",
+    ["route"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_connections_checked_out",
+    "Database connections currently checked out of the pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_SIZE = Gauge(
+    "db_pool_size",
+    "Configured size of the database connection pool",
+    multiprocess_mode="livemax",
+)
+
+WARMUP_DURATION = Gauge(
+    "app_warmup_seconds",
+    "Time spent warming up pools and clients before the worker became ready",
+    multiprocess_mode="max",
+)
+
+_current_route: contextvars.ContextVar[dict | None] = contextvars.ContextVar("metrics_current_route", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    current = _current_route.get()
+    if current is None:
+        DB_QUERIES.labels(route="other").inc()
+    else:
+        current["queries"] += 1
+
+
+@contextlib.contextmanager
+def track_queries(route: str) -> Iterator[None]:
+    current = {"queries": 0}
+    token = _current_route.set(current)
+    try:
+        yield
+    finally:
+        _current_route.reset(token)
+        DB_QUERIES.labels(route=route).inc(current["queries"])
+
+
+@contextlib.contextmanager
+def observe_storage(operation: str) -> Iterator[None]:
+    started = time.perf_counter()
+    outcome = "success"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        STORAGE_DURATION.labels(operation=operation, outcome=outcome).observe(time.perf_counter() - started)
+
+
+def observe_pool(engine) -> None:
+    # Plain values updated from pool events, set_function is not exported in multiprocess mode
+    pool = engine.sync_engine.pool
+    if hasattr(pool, "size"):
+        DB_POOL_SIZE.set(pool.size())
+    DB_POOL_CHECKED_OUT.set(pool.checkedout() if hasattr(pool, "checkedout") else 0)
+    event.listen(pool, "checkout", _count_checkout)
+    event.listen(pool, "checkin", _count_checkin)
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    DB_POOL_CHECKED_OUT.inc()
+
+
+def _count_checkin(dbapi_connection, connection_record) -> None:
+    DB_POOL_CHECKED_OUT.dec()
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        current = {"queries": 0}
+        token = _current_route.set(current)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_route.reset(token)
+            route = scope.get("route")
+            route_path = route.path if route else "unmatched"
+            HTTP_REQUEST_DURATION.labels(
+                method=scope["method"], route=route_path, status=str(status["code"])
+            ).observe(time.perf_counter() - started)
+            DB_QUERIES.labels(route=f"{scope['method']} {route_path}").inc(current["queries"])
+
+
+def metrics_endpoint(request: Request) -> Response:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead() -> None:
+    # Drops this worker's live gauge files so livesum/livemax stop counting a worker that is gone
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,247 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from dataclasses import dataclass
+
+from utils.metrics import LLM_RATE_LIMIT_WAIT, LLM_RATE_LIMIT_WAITERS
+
+# Lower numbers go first, a user waiting on a chat answer is served before background steps
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# "memory" limits each worker on its own, "database" shares the buckets of all workers
+LLM_RATE_LIMIT_BACKEND = os.environ.get("LLM_RATE_LIMIT_BACKEND", "database")
+# Share of each bucket background calls leave untouched, so chat keeps going while the other workers' steps queue up
+LLM_RATE_LIMIT_RESERVE = float(os.environ.get("LLM_RATE_LIMIT_RESERVE", "0.1"))
+# Requests and tokens per minute per model, "model=requests:tokens" separated by commas
+LLM_RATE_LIMITS = os.environ.get("LLM_RATE_LIMITS", "gpt-4o=5000:800000,gpt-4o-mini=5000:4000000")
+# Connections of the database backend, kept apart from the main pool so callers never wait on each other for one
+LLM_RATE_LIMIT_POOL_SIZE = int(os.environ.get("LLM_RATE_LIMIT_POOL_SIZE", "2"))
+# Longest a waiter sleeps before checking again, other workers may have left the bucket fuller than predicted
+LLM_RATE_LIMIT_MAX_SLEEP = 1.0
+
+
+@dataclass
+class RateLimit:
+    requests_per_minute: float
+    tokens_per_minute: float
+
+
+def parse_rate_limits(value: str) -> dict[str, RateLimit]:
+    # "gpt-4o=5000:800000,gpt-4o-mini=5000:4000000"
+    limits = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        model, _, limit = entry.partition("=")
+        requests_per_minute, _, tokens_per_minute = limit.partition(":")
+        limits[model.strip()] = RateLimit(float(requests_per_minute), float(tokens_per_minute))
+    return limits
+
+
+def refill(available: float, capacity: float, elapsed: float) -> float:
+    return min(capacity, available + elapsed * capacity / 60)
+
+
+def seconds_until(available: float, needed: float, capacity: float) -> float:
+    return max(0.0, (needed - available) * 60 / capacity)
+
+
+class MemoryRateLimitBackend:
+    def __init__(self):
+        # model -> (requests, tokens, updated_at)
+        self._buckets: dict[str, tuple[float, float, float]] = {}
+
+    async def take(self, model: str, limit: RateLimit, requests: float, tokens: float, reserve: float) -> float:
+        now = time.monotonic()
+        available_requests, available_tokens, updated_at = self._buckets.get(
+            model, (limit.requests_per_minute, limit.tokens_per_minute, now)
+        )
+        available_requests = refill(available_requests, limit.requests_per_minute, now - updated_at)
+        available_tokens = refill(available_tokens, limit.tokens_per_minute, now - updated_at)
+        needed_requests = requests + reserve * limit.requests_per_minute
+        needed_tokens = tokens + reserve * limit.tokens_per_minute
+        if available_requests >= needed_requests and available_tokens >= needed_tokens:
+            self._buckets[model] = (available_requests - requests, available_tokens - tokens, now)
+            return 0.0
+        self._buckets[model] = (available_requests, available_tokens, now)
+        return max(
+            seconds_until(available_requests, needed_requests, limit.requests_per_minute),
+            seconds_until(available_tokens, needed_tokens, limit.tokens_per_minute),
+        )
+
+    async def adjust(self, model: str, limit: RateLimit, tokens: float) -> None:
+        if model in self._buckets:
+            available_requests, available_tokens, updated_at = self._buckets[model]
+            self._buckets[model] = (available_requests, min(limit.tokens_per_minute, available_tokens - tokens), updated_at)
+
+    async def close(self) -> None:
+        pass
+
+
+class DatabaseRateLimitBackend:
+    """Buckets kept in one row per model, every take is a single conditional UPDATE.
+
+    Refilling uses the database clock, the workers' clocks never have to agree. The buckets go
+    through a small pool of their own, so LLM calls queued for their turn never compete with
+    requests and steps for connections of the main pool.
+    """
+
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self._sessionmanager = None
+
+    @property
+    def sessionmanager(self):
+        if self._sessionmanager is None:
+            from utils.db import DATABASE_URL, DatabaseSessionManager
+
+            self._sessionmanager = DatabaseSessionManager(
+                DATABASE_URL, engine_kwargs={"pool_size": self.pool_size, "max_overflow": 0}
+            )
+        return self._sessionmanager
+
+    async def close(self) -> None:
+        if self._sessionmanager is not None:
+            await self._sessionmanager.close()
+
+    async def take(self, model: str, limit: RateLimit, requests: float, tokens: float, reserve: float) -> float:
+        from sqlalchemy import func, select, update
+        from sqlalchemy.dialects.postgresql import insert
+
+        from models import LlmRateBucket
+
+        elapsed = func.extract("epoch", func.now() - LlmRateBucket.updated_at)
+        available_requests = func.least(limit.requests_per_minute, LlmRateBucket.requests + elapsed * limit.requests_per_minute / 60)
+        available_tokens = func.least(limit.tokens_per_minute, LlmRateBucket.tokens + elapsed * limit.tokens_per_minute / 60)
+        needed_requests = requests + reserve * limit.requests_per_minute
+        needed_tokens = tokens + reserve * limit.tokens_per_minute
+
+        async with self.sessionmanager.session() as session:
+            result = await session.execute(
+                update(LlmRateBucket)
+                .where(
+                    LlmRateBucket.model == model,
+                    available_requests >= needed_requests,
+                    available_tokens >= needed_tokens,
+                )
+                .values(
+                    requests=available_requests - requests,
+                    tokens=available_tokens - tokens,
+                    updated_at=func.now(),
+                )
+                .returning(LlmRateBucket.model)
+            )
+            if result.scalar_one_or_none() is not None:
+                await session.commit()
+                return 0.0
+
+            result = await session.execute(
+                select(available_requests, available_tokens).where(LlmRateBucket.model == model)
+            )
+            row = result.one_or_none()
+            if row is None:
+                # First call for this model, start with full buckets and take again
+                await session.execute(
+                    insert(LlmRateBucket)
+                    .values(model=model, requests=limit.requests_per_minute, tokens=limit.tokens_per_minute, updated_at=func.now())
+                    .on_conflict_do_nothing()
+                )
+                await session.commit()
+                return await self.take(model, limit, requests, tokens, reserve)
+            await session.rollback()
+        return max(
+            seconds_until(row[0], needed_requests, limit.requests_per_minute),
+            seconds_until(row[1], needed_tokens, limit.tokens_per_minute),
+        )
+
+    async def adjust(self, model: str, limit: RateLimit, tokens: float) -> None:
+        from sqlalchemy import func, update
+
+        from models import LlmRateBucket
+
+        async with self.sessionmanager.session() as session:
+            await session.execute(
+                update(LlmRateBucket)
+                .where(LlmRateBucket.model == model)
+                .values(tokens=func.least(limit.tokens_per_minute, LlmRateBucket.tokens - tokens))
+            )
+            await session.commit()
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute of every model.
+
+    Callers of one worker queue up by priority and only the first in line takes from the
+    backend, so a burst of background steps cannot overtake a chat message that arrived later.
+    """
+
+    def __init__(self, backend, limits: dict[str, RateLimit]):
+        self.backend = backend
+        self.limits = limits
+        self._waiters: dict[str, list[tuple[int, int]]] = {}
+        self._changed: dict[str, asyncio.Condition] = {}
+        self._sequence = itertools.count()
+
+    async def acquire(self, model: str, tokens: int, priority: int = PRIORITY_BACKGROUND) -> float:
+        # Returns the tokens actually charged, settle against those and not the requested amount
+        limit = self.limits.get(model)
+        if limit is None:
+            return 0
+        # A single call larger than the whole bucket would never fit, it waits for a full bucket instead
+        tokens = min(tokens, limit.tokens_per_minute * (1 - LLM_RATE_LIMIT_RESERVE))
+        reserve = LLM_RATE_LIMIT_RESERVE if priority > PRIORITY_INTERACTIVE else 0.0
+
+        waiters = self._waiters.setdefault(model, [])
+        changed = self._changed.setdefault(model, asyncio.Condition())
+        entry = (priority, next(self._sequence))
+        heapq.heappush(waiters, entry)
+        gauge = LLM_RATE_LIMIT_WAITERS.labels(model=model)
+        gauge.inc()
+        started = time.perf_counter()
+        try:
+            async with changed:
+                changed.notify_all()
+            while True:
+                if waiters[0] != entry:
+                    async with changed:
+                        await changed.wait_for(lambda: waiters[0] == entry)
+                wait = await self.backend.take(model, limit, 1, tokens, reserve)
+                if wait == 0:
+                    return tokens
+                # Wakes up early when someone more urgent queues, they get the next turn
+                async with changed:
+                    try:
+                        await asyncio.wait_for(changed.wait(), timeout=min(wait, LLM_RATE_LIMIT_MAX_SLEEP))
+                    except TimeoutError:
+                        pass
+        finally:
+            waiters.remove(entry)
+            heapq.heapify(waiters)
+            gauge.dec()
+            LLM_RATE_LIMIT_WAIT.labels(model=model, priority=str(priority)).observe(time.perf_counter() - started)
+            async with changed:
+                changed.notify_all()
+
+    async def settle(self, model: str, reserved_tokens: int, used_tokens: int) -> None:
+        # The bucket was charged an estimate up front, correct it once the real usage is known
+        limit = self.limits.get(model)
+        if limit is None or used_tokens == reserved_tokens:
+            return
+        await self.backend.adjust(model, limit, used_tokens - reserved_tokens)
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+
+def create_backend(name: str):
+    if name == "memory":
+        return MemoryRateLimitBackend()
+    if name == "database":
+        return DatabaseRateLimitBackend(pool_size=LLM_RATE_LIMIT_POOL_SIZE)
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+rate_limiter = RateLimiter(create_backend(LLM_RATE_LIMIT_BACKEND), parse_rate_limits(LLM_RATE_LIMITS))
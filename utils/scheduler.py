@@ -0,0 +1,139 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from utils.db import DATABASE_MAX_OVERFLOW, DATABASE_POOL_SIZE
+from utils.metrics import RUN_QUEUE_WAIT, RUNS_QUEUED, RUNS_RUNNING
+
+# A running step holds at most one pooled connection at a time and none while it waits on storage or
+# the LLM. Two thirds of the pool, less the LISTEN connection, go to runs, the rest is left for requests.
+DEFAULT_RUN_CONCURRENCY = max(1, (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW - 1) * 2 // 3)
+RUN_CONCURRENCY = int(os.environ.get("RUN_CONCURRENCY", str(DEFAULT_RUN_CONCURRENCY)))
+USER_RUN_CONCURRENCY = int(os.environ.get("USER_RUN_CONCURRENCY", "4"))
+MAX_QUEUED_RUNS = int(os.environ.get("MAX_QUEUED_RUNS", "500"))
+USER_MAX_QUEUED_RUNS = int(os.environ.get("USER_MAX_QUEUED_RUNS", "200"))
+MAX_RETRY_AFTER_SECONDS = 300
+
+
+class FairScheduler:
+    """Hands out run slots of this worker with weighted fair queuing across users.
+
+    Every user has a virtual finish time that grows by ``1 / weight`` per run started. The next
+    slot goes to the waiting user whose next run would finish first in virtual time, and a user
+    who was idle starts from the current virtual time instead of their old one. A user with a
+    long backlog therefore cannot delay another user's run by more than a slot turnover.
+    """
+
+    def __init__(self, capacity: int, user_capacity: int, max_queued: int, user_max_queued: int):
+        self.capacity = capacity
+        self.user_capacity = user_capacity
+        self.max_queued = max_queued
+        self.user_max_queued = user_max_queued
+        self.running = 0
+        self._running_by_user: dict[str, int] = {}
+        self._queues: dict[str, deque[tuple[asyncio.Future, float]]] = {}
+        self._finish_times: dict[str, float] = {}
+        self._virtual_time = 0.0
+        # Average time a run holds its slot, only used to tell rejected clients when to come back
+        self._average_run_seconds = 30.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def queued_for(self, user_id: str) -> int:
+        return len(self._queues.get(user_id, ()))
+
+    def check_admission(self, user_id: str, runs: int = 1) -> tuple[str, int] | None:
+        # Which limit the runs would exceed and the seconds until this worker can likely take them
+        if self.queued_for(user_id) + runs > self.user_max_queued:
+            limit, waiting, slots = "user", self.queued_for(user_id), self.user_capacity
+        elif self.queued + runs > self.max_queued:
+            limit, waiting, slots = "system", self.queued, self.capacity
+        else:
+            return None
+        estimate = math.ceil(self._average_run_seconds * (waiting + runs) / slots)
+        return limit, min(MAX_RETRY_AFTER_SECONDS, max(1, estimate))
+
+    async def acquire(self, user_id: str, weight: float = 1.0) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append((waiter, weight))
+        RUNS_QUEUED.inc()
+        started = time.perf_counter()
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over in the same loop iteration the caller got cancelled
+                self.release(user_id)
+            else:
+                self._forget(user_id, waiter)
+            raise
+        finally:
+            RUN_QUEUE_WAIT.observe(time.perf_counter() - started)
+
+    def release(self, user_id: str, run_seconds: float | None = None) -> None:
+        self.running -= 1
+        self._running_by_user[user_id] -= 1
+        if not self._running_by_user[user_id]:
+            del self._running_by_user[user_id]
+        RUNS_RUNNING.dec()
+        if run_seconds is not None:
+            self._average_run_seconds = 0.9 * self._average_run_seconds + 0.1 * run_seconds
+        self._dispatch()
+
+    def _next_finish_time(self, user_id: str) -> float:
+        _, weight = self._queues[user_id][0]
+        return max(self._finish_times.get(user_id, 0.0), self._virtual_time) + 1 / weight
+
+    def _dispatch(self) -> None:
+        while self.running < self.capacity:
+            eligible = [
+                user_id for user_id in self._queues
+                if self._running_by_user.get(user_id, 0) < self.user_capacity
+            ]
+            if not eligible:
+                break
+            user_id = min(eligible, key=self._next_finish_time)
+            finish_time = self._next_finish_time(user_id)
+            waiter, weight = self._queues[user_id].popleft()
+            if not self._queues[user_id]:
+                del self._queues[user_id]
+            RUNS_QUEUED.dec()
+
+            self._virtual_time = finish_time - 1 / weight
+            self._finish_times[user_id] = finish_time
+            self.running += 1
+            self._running_by_user[user_id] = self._running_by_user.get(user_id, 0) + 1
+            RUNS_RUNNING.inc()
+            waiter.set_result(None)
+        self._forget_idle_users()
+
+    def _forget(self, user_id: str, waiter: asyncio.Future) -> None:
+        queue = self._queues.get(user_id)
+        if queue is None:
+            return
+        for entry in queue:
+            if entry[0] is waiter:
+                queue.remove(entry)
+                RUNS_QUEUED.dec()
+                break
+        if not queue:
+            del self._queues[user_id]
+
+    def _forget_idle_users(self) -> None:
+        # Finish times at or behind the virtual time make no difference anymore
+        for user_id in [user_id for user_id, finish_time in self._finish_times.items() if finish_time <= self._virtual_time]:
+            if user_id not in self._queues:
+                del self._finish_times[user_id]
+
+
+run_scheduler = FairScheduler(
+    capacity=RUN_CONCURRENCY,
+    user_capacity=USER_RUN_CONCURRENCY,
+    max_queued=MAX_QUEUED_RUNS,
+    user_max_queued=USER_MAX_QUEUED_RUNS,
+)
@@ -0,0 +1,67 @@
+import asyncio
+import mmap
+import os
+import uuid
+
+from opentelemetry.trace import SpanKind
+
+from utils.blob_cache import blob_cache
+from utils.metrics import BLOB_CACHE_LOOKUPS, STORAGE_BYTES, observe_storage
+from utils.tracing import tracer
+
+HOMEWORK_BUCKET = "homework-files"
+
+
+def homework_storage_path(user_id: str, filename: str) -> str:
+    return f"{user_id}/homeworks/{uuid.uuid4()}_{os.path.basename(filename)}"
+
+
+async def upload_object(supabase_client, path: str, contents: bytes, bucket: str = HOMEWORK_BUCKET, cache: bool = True) -> None:
+    with tracer.start_as_current_span("storage.upload", kind=SpanKind.CLIENT) as span, observe_storage("upload"):
+        span.set_attributes({"storage.bucket": bucket, "storage.path": path, "storage.bytes": len(contents)})
+        await supabase_client.storage.from_(bucket).upload(path, contents)
+    STORAGE_BYTES.labels(operation="upload").inc(len(contents))
+    # Write through so the steps that read the object right after do not download it again
+    if cache:
+        await asyncio.to_thread(blob_cache.put, contents, f"{bucket}/{path}")
+
+
+async def download_object(supabase_client, path: str, bucket: str = HOMEWORK_BUCKET) -> bytes:
+    with tracer.start_as_current_span("storage.download", kind=SpanKind.CLIENT) as span, observe_storage("download"):
+        span.set_attributes({"storage.bucket": bucket, "storage.path": path})
+        contents = await supabase_client.storage.from_(bucket).download(path)
+        span.set_attribute("storage.bytes", len(contents))
+    STORAGE_BYTES.labels(operation="download").inc(len(contents))
+    return contents
+
+
+async def read_object(supabase_client, path: str, bucket: str = HOMEWORK_BUCKET) -> bytes | mmap.mmap:
+    cached = await asyncio.to_thread(blob_cache.get_by_key, f"{bucket}/{path}")
+    if cached is not None:
+        BLOB_CACHE_LOOKUPS.labels(result="hit").inc()
+        return cached
+
+    BLOB_CACHE_LOOKUPS.labels(result="miss").inc()
+    contents = await download_object(supabase_client, path, bucket)
+    await asyncio.to_thread(blob_cache.put, contents, f"{bucket}/{path}")
+    return contents
+
+
+async def create_signed_upload(supabase_client, path: str, bucket: str = HOMEWORK_BUCKET) -> dict:
+    with tracer.start_as_current_span("storage.create_signed_upload", kind=SpanKind.CLIENT) as span, observe_storage("create_signed_upload"):
+        span.set_attributes({"storage.bucket": bucket, "storage.path": path})
+        return await supabase_client.storage.from_(bucket).create_signed_upload_url(path)
+
+
+async def object_exists(supabase_client, path: str, bucket: str = HOMEWORK_BUCKET) -> bool:
+    with tracer.start_as_current_span("storage.exists", kind=SpanKind.CLIENT) as span, observe_storage("exists"):
+        span.set_attributes({"storage.bucket": bucket, "storage.path": path})
+        exists = await supabase_client.storage.from_(bucket).exists(path)
+        span.set_attribute("storage.exists", exists)
+    return exists
+
+
+async def remove_objects(supabase_client, paths: list[str], bucket: str = HOMEWORK_BUCKET) -> None:
+    with tracer.start_as_current_span("storage.remove", kind=SpanKind.CLIENT) as span, observe_storage("remove"):
+        span.set_attributes({"storage.bucket": bucket, "storage.objects": len(paths)})
+        await supabase_client.storage.from_(bucket).remove(paths)
@@ -0,0 +1,136 @@
+import os
+import threading
+from typing import Sequence
+
+from opentelemetry import context as otel_context
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter, SpanExportResult
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+
+tracer = trace.get_tracer("impehrium")
+
+
+class JsonLinesFileSpanExporter(SpanExporter):
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        with self._lock, open(self._path, "a") as file:
+            for span in spans:
+                file.write(span.to_json(indent=None) + "\n")
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        pass
+
+
+def configure_tracing() -> None:
+    exporter_name = os.environ.get("TRACING_EXPORTER", "none").lower()
+    if exporter_name == "none":
+        return
+    if exporter_name == "console":
+        exporter = ConsoleSpanExporter()
+    elif exporter_name == "file":
+        exporter = JsonLinesFileSpanExporter(os.environ.get("TRACING_FILE", "traces.jsonl"))
+    else:
+        raise ValueError(f"Unknown TRACING_EXPORTER: {exporter_name}")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "impehrium-api"}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_span(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    span = tracer.start_span(
+        "db.query",
+        kind=SpanKind.CLIENT,
+        attributes={
+            "db.system": conn.dialect.name,
+            "db.operation": statement.split(None, 1)[0].upper() if statement else "",
+            "db.statement": statement[:500],
+        },
+    )
+    context._trace_span = span
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query_span(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, "_trace_span", None)
+    if span is not None:
+        span.end()
+        context._trace_span = None
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_query_span(exception_context):
+    span = getattr(exception_context.execution_context, "_trace_span", None)
+    if span is not None:
+        span.record_exception(exception_context.original_exception)
+        span.set_status(Status(StatusCode.ERROR))
+        span.end()
+        exception_context.execution_context._trace_span = None
+
+
+class TracedAsyncSession(AsyncSession):
+    async def commit(self) -> None:
+        with tracer.start_as_current_span("db.commit", kind=SpanKind.CLIENT):
+            await super().commit()
+
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        span = tracer.start_span(
+            f"{scope['method']} {scope['path']}",
+            context=propagate.extract(headers),
+            kind=SpanKind.SERVER,
+            attributes={"http.method": scope["method"], "http.target": scope["path"]},
+        )
+
+        # Background tasks run after the response inside the same ASGI call, the request span
+        # ends with the response body so it does not absorb them, they get their own step spans.
+        def finish():
+            if not span.is_recording():
+                return
+            route = scope.get("route")
+            if route is not None:
+                span.update_name(f"{scope['method']} {route.path}")
+                span.set_attribute("http.route", route.path)
+            span.end()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    span.set_status(Status(StatusCode.ERROR))
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        token = otel_context.attach(trace.set_span_in_context(span))
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            if span.is_recording():
+                span.record_exception(e)
+                span.set_status(Status(StatusCode.ERROR))
+            raise
+        finally:
+            finish()
+            otel_context.detach(token)
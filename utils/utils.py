@@ -1,13 +1,20 @@
 import os
-
-import supabase
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    import supabase
+
 load_dotenv()
 
-SUPABASE_URL = os.environ["SUPABASE_URL"]
-SUPABASE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+_supabase_client: "supabase.AsyncClient | None" = None
+
+
+async def get_supabase_client() -> "supabase.AsyncClient":
+    global _supabase_client
+    if _supabase_client is None:
+        from supabase import acreate_client
 
-async def get_supabase_client() -> supabase.AsyncClient:
-    return await supabase.acreate_client(SUPABASE_URL, SUPABASE_KEY)
+        _supabase_client = await acreate_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE_KEY"])
+    return _supabase_client